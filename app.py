@@ -1,13 +1,41 @@
 import streamlit as st
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.generativeai.client import FileServiceClient
+from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from dotenv import load_dotenv
 import os
+import sys
 import json
 import datetime
-from typing import Dict, List
+import dataclasses
+from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Optional, Tuple
 import time
 import re
 import base64
+import io
+import uuid
+import hashlib
+import hmac
+import sqlite3
+import threading
+import atexit
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 # Load environment variables
 load_dotenv()
@@ -577,6 +605,422 @@ def create_app_header():
         unsafe_allow_html=True
     )
 
+# Per-session memory budget before cold saved conversations are evicted (they reload from the journal)
+SESSION_MEMORY_CAP_MB = float(os.getenv("FLUXCODE_SESSION_MEMORY_MB", "8"))
+
+# Where session state lives: "sqlite" (single host) or "redis" (shared by replicas)
+STATE_BACKEND = os.getenv("FLUXCODE_STATE_BACKEND", "sqlite").lower()
+STATE_DB_PATH = os.getenv("FLUXCODE_STATE_DB", "fluxcode_state.db")
+REDIS_URL = os.getenv("FLUXCODE_REDIS_URL", "redis://localhost:6379/0")
+SESSION_PARAM = "sid"
+
+# Write-behind journal: max delay before queued messages are flushed, and
+# how many appended entries trigger a compaction check
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("FLUXCODE_JOURNAL_FLUSH_MS", "500")) / 1000
+JOURNAL_COMPACT_EVERY = 256
+
+# Session state keys persisted to the backend; messages are journaled separately
+PERSISTED_KEYS = [
+    "saved_conversations",
+    "current_conversation_id",
+    "conversation_title",
+    "current_model",
+    "user_preferences",
+    "code_gen_mode",
+    "explain_mode",
+    "debug_mode",
+    "patch_mode",
+    "response_style",
+    "working_files"
+]
+
+# Rough size of a slotted Message instance excluding its content string
+MESSAGE_OVERHEAD_BYTES = 72
+
+@dataclass(frozen=True)
+class Message:
+    """Compact, immutable chat message shared between live and saved conversations"""
+    __slots__ = ("role", "content", "index", "timestamp", "alternatives", "attachments")
+    role: str
+    content: str
+    index: int
+    timestamp: int
+    alternatives: tuple  # cached regenerate candidates, including content; () if none
+    attachments: tuple  # (hash, name, mime_type, original_size, prepared_size) per attached file
+
+    def __post_init__(self):
+        # Roles come back from disk as fresh strings; intern them so they are shared
+        object.__setattr__(self, "role", sys.intern(self.role))
+
+    @property
+    def id(self) -> str:
+        return f"{self.role}_{self.index}"
+
+    def to_dict(self) -> Dict:
+        """Expand to the JSON-friendly dict used for export"""
+        return {
+            "role": self.role,
+            "content": self.content,
+            "id": self.id,
+            "timestamp": datetime.datetime.fromtimestamp(self.timestamp).isoformat(),
+            **({"alternatives": list(self.alternatives)} if self.alternatives else {}),
+            **({"attachments": [a[1] for a in self.attachments]} if self.attachments else {})
+        }
+
+    def to_record(self) -> list:
+        """Serialize to a compact list for storage"""
+        record = [self.role, self.content, self.index, self.timestamp]
+        if self.alternatives or self.attachments:
+            record.append(list(self.alternatives))
+        if self.attachments:
+            record.append([list(a) for a in self.attachments])
+        return record
+
+    @classmethod
+    def from_record(cls, record: list) -> "Message":
+        """Rebuild a message from its compact storage form"""
+        role, content, index, timestamp, *rest = record
+        alternatives = tuple(content if alt == content else alt for alt in rest[0]) if rest else ()
+        attachments = tuple(tuple(a) for a in rest[1]) if len(rest) > 1 else ()
+        return cls(role, content, index, timestamp, alternatives, attachments)
+
+def new_message(role: str, content: str, attachments: tuple = ()) -> Message:
+    """Create the next message for the current conversation"""
+    return Message(role, content, len(st.session_state.messages), int(time.time()), (), attachments)
+
+class StateBackend(ABC):
+    """Versioned key/value store for session state plus append-only conversation logs"""
+
+    @abstractmethod
+    def get(self, key: str) -> Tuple[int, Optional[str]]:
+        """Return (version, payload); version 0 means the key does not exist"""
+
+    @abstractmethod
+    def put(self, key: str, payload: str, expected_version: int) -> bool:
+        """Write payload if the stored version still matches; False on a concurrent update"""
+
+    @abstractmethod
+    def append_log(self, key: str, entries: List[str]) -> None:
+        """Append entries to the end of a log"""
+
+    @abstractmethod
+    def read_log(self, key: str) -> List[str]:
+        """Return every entry of a log, oldest first"""
+
+    @abstractmethod
+    def replace_log(self, key: str, entries: List[str]) -> None:
+        """Atomically swap a log for its compacted form"""
+
+    @abstractmethod
+    def delete_log(self, key: str) -> None:
+        """Remove a log and its entries"""
+
+class SQLiteStateBackend(StateBackend):
+    """Single-file backend; safe to share between processes on one host"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, version INTEGER NOT NULL, payload TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, entry TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS journal_key ON journal (key, id)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT version, payload FROM state WHERE key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    def put(self, key, payload, expected_version):
+        with self.lock, self.conn:
+            if expected_version == 0:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO state (key, version, payload) VALUES (?, 1, ?)", (key, payload)
+                )
+            else:
+                cursor = self.conn.execute(
+                    "UPDATE state SET version = version + 1, payload = ? WHERE key = ? AND version = ?",
+                    (payload, key, expected_version)
+                )
+        return cursor.rowcount == 1
+
+    def append_log(self, key, entries):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO journal (key, entry) VALUES (?, ?)", [(key, e) for e in entries])
+
+    def read_log(self, key):
+        with self.lock:
+            rows = self.conn.execute("SELECT entry FROM journal WHERE key = ? ORDER BY id", (key,)).fetchall()
+        return [row[0] for row in rows]
+
+    def replace_log(self, key, entries):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM journal WHERE key = ?", (key,))
+            self.conn.executemany("INSERT INTO journal (key, entry) VALUES (?, ?)", [(key, e) for e in entries])
+
+    def delete_log(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM journal WHERE key = ?", (key,))
+
+class RedisStateBackend(StateBackend):
+    """Backend for any Redis-protocol server, shared by all replicas"""
+
+    def __init__(self, url: str, prefix: str = "fluxcode"):
+        if redis is None:
+            raise RuntimeError("The redis package is required for FLUXCODE_STATE_BACKEND=redis")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _state_key(self, key):
+        return f"{self.prefix}:state:{key}"
+
+    def _log_key(self, key):
+        return f"{self.prefix}:log:{key}"
+
+    def get(self, key):
+        version, payload = self.client.hmget(self._state_key(key), "version", "payload")
+        return (int(version), payload) if version else (0, None)
+
+    def put(self, key, payload, expected_version):
+        state_key = self._state_key(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(state_key)
+                if int(pipe.hget(state_key, "version") or 0) != expected_version:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.hset(state_key, mapping={"version": expected_version + 1, "payload": payload})
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def append_log(self, key, entries):
+        self.client.rpush(self._log_key(key), *entries)
+
+    def read_log(self, key):
+        return self.client.lrange(self._log_key(key), 0, -1)
+
+    def replace_log(self, key, entries):
+        with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._log_key(key))
+            if entries:
+                pipe.rpush(self._log_key(key), *entries)
+            pipe.execute()
+
+    def delete_log(self, key):
+        self.client.delete(self._log_key(key))
+
+@st.cache_resource
+def get_state_backend() -> StateBackend:
+    """Process-wide state backend selected by FLUXCODE_STATE_BACKEND"""
+    if STATE_BACKEND == "redis":
+        return RedisStateBackend(REDIS_URL)
+    return SQLiteStateBackend(STATE_DB_PATH)
+
+def get_session_key() -> str:
+    """Resolve the session key from the query string or cookie, minting one if absent"""
+    key = st.query_params.get(SESSION_PARAM)
+    if not key:
+        context = getattr(st, "context", None)
+        key = (getattr(context, "cookies", None) or {}).get(SESSION_PARAM)
+    if not key or not re.fullmatch(r"[A-Za-z0-9_-]{8,64}", key):
+        key = uuid.uuid4().hex
+    # Keep the key in the URL so reloads and other replicas resolve the same session
+    if st.query_params.get(SESSION_PARAM) != key:
+        st.query_params[SESSION_PARAM] = key
+    return key
+
+def replay_journal(entries) -> list:
+    """Fold journal entries into the message records they describe.
+
+    Tabs sharing a session append to the same log, so each message is placed
+    at its own index: a later message at an index replaces the one there and
+    everything after it. Entries beyond the end of the transcript belong to
+    one another tab has since truncated, and are skipped.
+    """
+    records = []
+    for entry in entries:
+        if entry[0] == "m":
+            index = entry[1][2]
+            if index <= len(records):
+                del records[index:]
+                records.append(entry[1])
+        elif entry[0] == "t":
+            del records[entry[1]:]
+        elif entry[0] == "r":
+            if entry[1] < len(records):
+                records[entry[1]] = entry[2]
+    return records
+
+class Journal:
+    """Write-behind conversation log: appends are queued and flushed in batches by a background thread"""
+
+    def __init__(self, backend: StateBackend, flush_interval: float, compact_every: int):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.pending: Dict[str, list] = {}
+        self.since_compaction: Dict[str, int] = {}
+        self.cond = threading.Condition()
+        # Held while writing so readers and drops never race a batch in flight
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="fluxcode-journal", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def append(self, key: str, entry: list):
+        """Queue an entry: ["m", record] appends a message, ["t", n] truncates to n messages,
+        ["r", i, record] replaces message i"""
+        with self.cond:
+            if entry[0] == "t" and entry[1] == 0:
+                # Truncating to empty supersedes anything still queued for this log
+                self.pending[key] = []
+            self.pending.setdefault(key, []).append(entry)
+            self.cond.notify()
+
+    def read(self, key: str) -> list:
+        """Return the current message records of a log, including queued entries"""
+        self.flush(key)
+        return replay_journal(json.loads(e) for e in self.backend.read_log(key))
+
+    def backlog(self) -> int:
+        """Entries queued but not yet written to the backend"""
+        with self.cond:
+            return sum(len(entries) for entries in self.pending.values())
+
+    def drop(self, key: str):
+        with self.flush_lock:
+            with self.cond:
+                self.pending.pop(key, None)
+            self.since_compaction.pop(key, None)
+            self.backend.delete_log(key)
+
+    def flush(self, key: Optional[str] = None):
+        with self.flush_lock:
+            with self.cond:
+                if key is None:
+                    batch, self.pending = self.pending, {}
+                else:
+                    batch = {key: self.pending.pop(key)} if key in self.pending else {}
+            for log_key, entries in batch.items():
+                if not entries:
+                    continue
+                try:
+                    if entries[0] == ["t", 0]:
+                        # The log restarts from empty, so rewrite it instead of appending
+                        self.backend.replace_log(log_key, [json.dumps(e, separators=(",", ":")) for e in entries[1:]])
+                        self.since_compaction[log_key] = 0
+                    else:
+                        self.backend.append_log(log_key, [json.dumps(e, separators=(",", ":")) for e in entries])
+                        self._maybe_compact(log_key, len(entries))
+                except Exception:
+                    # Put the batch back in front of newer entries and retry on the next flush
+                    with self.cond:
+                        self.pending[log_key] = entries + self.pending.get(log_key, [])
+
+    def _maybe_compact(self, key: str, appended: int):
+        count = self.since_compaction.get(key, 0) + appended
+        self.since_compaction[key] = count
+        if count < self.compact_every:
+            return
+        self.since_compaction[key] = 0
+        entries = self.backend.read_log(key)
+        records = replay_journal(json.loads(e) for e in entries)
+        if len(records) < len(entries):
+            self.backend.replace_log(key, [json.dumps(["m", r], separators=(",", ":")) for r in records])
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # Give further appends a moment to coalesce; this bounds flush latency
+            time.sleep(self.flush_interval)
+            self.flush()
+
+@st.cache_resource
+def get_journal() -> Journal:
+    """Process-wide journal writing to the state backend"""
+    return Journal(get_state_backend(), JOURNAL_FLUSH_INTERVAL, JOURNAL_COMPACT_EVERY)
+
+def journal_key(conv_id: str) -> str:
+    """Log key for a conversation of the current session"""
+    return f"{st.session_state.session_id}:{conv_id}"
+
+def read_conversation_log(conv_id: str, limit: Optional[int] = None) -> tuple:
+    """Rebuild a conversation's messages from its journal"""
+    records = get_journal().read(journal_key(conv_id))
+    return tuple(Message.from_record(r) for r in records[:limit])
+
+def append_message(role: str, content: str, attachments: tuple = ()) -> Message:
+    """Add a message to the current conversation and journal it"""
+    if st.session_state.current_conversation_id is None:
+        st.session_state.current_conversation_id = uuid.uuid4().hex[:12]
+    message = new_message(role, content, attachments)
+    st.session_state.messages.append(message)
+    get_journal().append(journal_key(st.session_state.current_conversation_id), ["m", message.to_record()])
+    return message
+
+def replace_message(message: Message):
+    """Swap a message of the current conversation in place and journal the change"""
+    st.session_state.messages[message.index] = message
+    get_journal().append(
+        journal_key(st.session_state.current_conversation_id),
+        ["r", message.index, message.to_record()]
+    )
+
+def discard_current_conversation():
+    """Start over with an empty transcript, dropping the log of an unsaved conversation"""
+    conv_id = st.session_state.current_conversation_id
+    if conv_id is not None and conv_id not in st.session_state.saved_conversations:
+        get_journal().drop(journal_key(conv_id))
+        drop_working_file(conv_id)
+    st.session_state.messages = []
+    st.session_state.routes = {}
+    st.session_state.current_conversation_id = None
+
+def estimate_session_memory() -> int:
+    """Estimate bytes held by live and in-memory saved messages, counting shared messages once"""
+    seen = set()
+    total = 0
+    transcripts = [st.session_state.messages] + [
+        conv["messages"] for conv in st.session_state.saved_conversations.values()
+        if conv["messages"] is not None
+    ]
+    for messages in transcripts:
+        for message in messages:
+            if id(message) not in seen:
+                seen.add(id(message))
+                total += sys.getsizeof(message.content) + MESSAGE_OVERHEAD_BYTES
+                total += sum(sys.getsizeof(alt) for alt in message.alternatives if alt is not message.content)
+    return total
+
+def enforce_memory_cap():
+    """Evict least recently used saved conversations from memory while over the session cap"""
+    cap = int(SESSION_MEMORY_CAP_MB * 1024 * 1024)
+    if estimate_session_memory() <= cap:
+        return
+
+    cold = sorted(
+        (
+            (conv_id, conv) for conv_id, conv in st.session_state.saved_conversations.items()
+            if conv["messages"] is not None and conv_id != st.session_state.current_conversation_id
+        ),
+        key=lambda item: item[1].get("last_access", 0)
+    )
+    for conv_id, conv in cold:
+        # Messages are already durable in the conversation's journal
+        conv["messages"] = None
+        if estimate_session_memory() <= cap:
+            break
+
 def initialize_session_state():
     """Initialize all session state variables"""
     defaults = {
@@ -596,39 +1040,130 @@ def initialize_session_state():
         "code_gen_mode": False,
         "explain_mode": False,
         "debug_mode": False,
-        "response_style": "Balanced"
+        "patch_mode": False,
+        "response_style": "Balanced",
+        "working_files": {},
+        "working_file_versions": {},
+        "run_results": {},
+        "run_feedback": True,
+        "pending_run_error": None,
+        "uploader_key": 0,
+        "routes": {},
+        "last_route": None
     }
     
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
 
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = get_session_key()
+        load_session_state()
+    elif st.session_state.get("_ops_handle") and st.session_state._ops_handle.evicted:
+        # An operator evicted this idle session; reload the open conversation from its journal
+        st.session_state._ops_handle.evicted = False
+        load_session_state()
+    report_session()
+
 def save_conversation():
     """Save current conversation"""
     if not st.session_state.messages:
         return
     
-    conv_id = st.session_state.current_conversation_id or str(int(time.time()))
+    # Message bodies are already in the conversation's journal, so saving only
+    # records metadata; the in-memory tuple shares the live Message objects
+    conv_id = st.session_state.current_conversation_id
     st.session_state.saved_conversations[conv_id] = {
         "title": st.session_state.conversation_title,
-        "messages": st.session_state.messages.copy(),
+        "messages": tuple(st.session_state.messages),
         "timestamp": datetime.datetime.now().isoformat(),
         "message_count": len(st.session_state.messages),
-        "model": st.session_state.current_model
+        "model": st.session_state.current_model,
+        "last_access": time.time()
     }
-    st.session_state.current_conversation_id = conv_id
+    enforce_memory_cap()
     st.toast("Conversation saved successfully!")
 
 def load_conversation(conv_id):
     """Load a saved conversation"""
     if conv_id in st.session_state.saved_conversations:
         conv = st.session_state.saved_conversations[conv_id]
-        st.session_state.messages = conv["messages"]
+        if conv["messages"] is None:
+            conv["messages"] = read_conversation_log(conv_id, conv["message_count"])
+        if st.session_state.current_conversation_id != conv_id:
+            discard_current_conversation()
+        # Drop anything journaled after the save so new messages continue from it
+        get_journal().append(journal_key(conv_id), ["t", conv["message_count"]])
+        conv["last_access"] = time.time()
+        st.session_state.messages = list(conv["messages"])
         st.session_state.conversation_title = conv["title"]
         st.session_state.current_conversation_id = conv_id
         st.session_state.current_model = conv.get("model", "gemini-pro")
+        enforce_memory_cap()
         st.rerun()
 
+def delete_conversation(conv_id):
+    """Delete a saved conversation and its journal unless it is still open"""
+    st.session_state.saved_conversations.pop(conv_id, None)
+    if st.session_state.current_conversation_id != conv_id:
+        get_journal().drop(journal_key(conv_id))
+        drop_working_file(conv_id)
+
+def serialize_session_state() -> str:
+    """Serialize session metadata to JSON; message bodies live in the journal"""
+    state = {key: st.session_state[key] for key in PERSISTED_KEYS}
+    state["saved_conversations"] = {
+        conv_id: {k: v for k, v in conv.items() if k != "messages"}
+        for conv_id, conv in state["saved_conversations"].items()
+    }
+    return json.dumps(state, separators=(",", ":"))
+
+def deserialize_session_state(payload: str) -> Dict:
+    """Parse serialized session metadata; saved transcripts are read from the journal on load"""
+    state = json.loads(payload)
+    for conv in state["saved_conversations"].values():
+        conv["messages"] = None
+    return state
+
+def load_session_state():
+    """Hydrate session state from the backend and replay the open conversation's journal"""
+    version, payload = get_state_backend().get(st.session_state.session_id)
+    if payload:
+        for key, value in deserialize_session_state(payload).items():
+            st.session_state[key] = value
+    st.session_state._state_version = version
+    st.session_state._state_digest = hashlib.sha1(payload.encode()).hexdigest() if payload else None
+
+    conv_id = st.session_state.current_conversation_id
+    if conv_id is not None:
+        st.session_state.messages = list(read_conversation_log(conv_id))
+        if st.session_state.messages and conv_id not in st.session_state.saved_conversations:
+            st.toast("Recovered your unsaved conversation")
+
+def persist_session_state():
+    """Write session state to the backend if it changed, retrying on concurrent tab updates"""
+    payload = serialize_session_state()
+    digest = hashlib.sha1(payload.encode()).hexdigest()
+    if digest == st.session_state._state_digest:
+        return
+
+    backend = get_state_backend()
+    session_id = st.session_state.session_id
+    for _ in range(3):
+        if backend.put(session_id, payload, st.session_state._state_version):
+            st.session_state._state_version += 1
+            st.session_state._state_digest = digest
+            return
+        # Another tab wrote first: keep our live state but adopt conversations it saved
+        version, remote = backend.get(session_id)
+        st.session_state._state_version = version
+        if remote:
+            for conv_id, conv in deserialize_session_state(remote)["saved_conversations"].items():
+                st.session_state.saved_conversations.setdefault(conv_id, conv)
+        payload = serialize_session_state()
+        digest = hashlib.sha1(payload.encode()).hexdigest()
+    st.warning("Session state changed in another tab; your latest changes were not stored")
+
 def export_conversation():
     """Export conversation to JSON"""
     if not st.session_state.messages:
@@ -637,7 +1172,7 @@ def export_conversation():
     export_data = {
         "title": st.session_state.conversation_title,
         "timestamp": datetime.datetime.now().isoformat(),
-        "messages": st.session_state.messages,
+        "messages": [m.to_dict() for m in st.session_state.messages],
         "model": st.session_state.current_model,
         "stats": {
             "message_count": len(st.session_state.messages),
@@ -657,14 +1192,19 @@ def create_sidebar():
         st.markdown('<div class="sidebar-section">', unsafe_allow_html=True)
         st.markdown('<div class="section-title">🔧 Configuration</div>', unsafe_allow_html=True)
         
+        pool = get_key_pool()
         api_key = st.text_input(
             "Gemini API Key:",
             type="password",
-            help="Enter your Google Gemini API key",
-            value=os.getenv("GOOGLE_API_KEY", "")
+            key="api_key",
+            help=(
+                f"Leave empty to use the shared pool of {len(pool)} key(s)"
+                if len(pool) else "Enter your Google Gemini API key"
+            )
         )
 
         model_options = [
+            AUTO_MODEL,
             "gemini-2.0-flash",
             "gemini-1.5-pro",
             "gemini-1.5-flash"
@@ -674,9 +1214,12 @@ def create_sidebar():
         selected_model = st.selectbox(
             "Model:",
             model_options,
-            index=default_index
+            index=default_index,
+            help="Auto sends each turn to the fastest model likely to handle it"
         )
         st.session_state.current_model = selected_model
+        if selected_model == AUTO_MODEL and st.session_state.last_route:
+            st.caption(f"Last turn: {AUTO_ROUTES[st.session_state.last_route]}")
         
         st.markdown('</div>', unsafe_allow_html=True)
         
@@ -693,6 +1236,13 @@ def create_sidebar():
         debug_mode = st.checkbox("🐛 Debug Mode", 
                                value=st.session_state.debug_mode,
                                help="Help debug code issues")
+        run_feedback = st.checkbox("🔁 Send Run Errors to Debug Mode",
+                                 value=st.session_state.run_feedback,
+                                 disabled=not debug_mode,
+                                 help="Include the traceback of a failed ▶️ Run in the next Debug Mode prompt")
+        patch_mode = st.checkbox("🩹 Patch Mode", 
+                               value=st.session_state.patch_mode,
+                               help="Keep a working file and ask for edits instead of full rewrites")
         
         response_style = st.radio(
             "Response Style:",
@@ -703,6 +1253,8 @@ def create_sidebar():
         st.session_state.code_gen_mode = code_gen_mode
         st.session_state.explain_mode = explain_mode
         st.session_state.debug_mode = debug_mode
+        st.session_state.patch_mode = patch_mode
+        st.session_state.run_feedback = run_feedback
         st.session_state.response_style = response_style
         
         st.markdown('</div>', unsafe_allow_html=True)
@@ -720,6 +1272,22 @@ def create_sidebar():
         
         st.markdown('</div>', unsafe_allow_html=True)
         
+        # Key Pool Section
+        if len(pool) > 1:
+            st.markdown('<div class="sidebar-section">', unsafe_allow_html=True)
+            st.markdown('<div class="section-title">🔑 Key Pool</div>', unsafe_allow_html=True)
+            
+            metrics = pool.metrics()
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("In Flight", sum(m["in_flight"] for m in metrics))
+            with col2:
+                st.metric("Healthy Keys", sum(1 for m in metrics if not m["quarantined_s"]))
+            with st.expander("Per-key usage"):
+                st.dataframe(metrics, hide_index=True, use_container_width=True)
+            
+            st.markdown('</div>', unsafe_allow_html=True)
+        
         # Conversation Management
         st.markdown('<div class="sidebar-section">', unsafe_allow_html=True)
         st.markdown('<div class="section-title">💾 Conversations</div>', unsafe_allow_html=True)
@@ -740,15 +1308,14 @@ def create_sidebar():
             if st.button("🆕 New", use_container_width=True):
                 if st.session_state.user_preferences["auto_save"] and st.session_state.messages:
                     save_conversation()
-                st.session_state.messages = []
-                st.session_state.current_conversation_id = None
+                discard_current_conversation()
                 st.session_state.conversation_title = "New Conversation"
                 st.rerun()
         
         # Saved Conversations
         if st.session_state.saved_conversations:
             st.markdown("**Saved Conversations:**")
-            for conv_id, conv in st.session_state.saved_conversations.items():
+            for conv_id, conv in list(st.session_state.saved_conversations.items()):
                 col1, col2 = st.columns([3, 1])
                 with col1:
                     if st.button(
@@ -759,9 +1326,7 @@ def create_sidebar():
                         load_conversation(conv_id)
                 with col2:
                     if st.button("🗑️", key=f"del_{conv_id}"):
-                        del st.session_state.saved_conversations[conv_id]
-                        if st.session_state.current_conversation_id == conv_id:
-                            st.session_state.current_conversation_id = None
+                        delete_conversation(conv_id)
                         st.rerun()
         
         st.markdown('</div>', unsafe_allow_html=True)
@@ -782,15 +1347,30 @@ def create_sidebar():
                 )
             
             if st.button("🗑️ Clear History", use_container_width=True):
-                st.session_state.messages = []
+                discard_current_conversation()
                 st.rerun()
             
             st.markdown('</div>', unsafe_allow_html=True)
     
     return api_key
 
-def format_response_with_mode(prompt: str) -> str:
+def format_response_with_mode(prompt: str, allow_edits: bool = True, include_run_error: bool = True) -> str:
     """Format the prompt based on selected modes"""
+    if st.session_state.patch_mode:
+        working_file = get_working_file()
+        if working_file is not None:
+            if allow_edits:
+                prompt += "\n\n" + PATCH_INSTRUCTIONS.format(
+                    version=len(working_file["versions"]),
+                    language=working_file["language"],
+                    content=working_file["versions"][-1]
+                )
+            else:
+                prompt += (
+                    "\n\nReply with the complete updated working file in a single code block.\n\n"
+                    f"Current working file:\n```{working_file['language']}\n{working_file['versions'][-1]}\n```"
+                )
+    
     prefix_parts = []
     
     if st.session_state.code_gen_mode:
@@ -801,6 +1381,9 @@ def format_response_with_mode(prompt: str) -> str:
     
     if st.session_state.debug_mode:
         prefix_parts.append("Help debug and identify issues")
+        if include_run_error and st.session_state.pending_run_error:
+            prompt += f"\n\nRunning the code failed with:\n```\n{st.session_state.pending_run_error}\n```"
+            st.session_state.pending_run_error = None
     
     style_instructions = {
         "Concise": "Keep responses brief and to the point",
@@ -815,68 +1398,1612 @@ def format_response_with_mode(prompt: str) -> str:
         return prefix + "\n\n" + prompt
     return prompt
 
+# Rendering limits that keep the browser payload per rerun bounded
+LARGE_CODE_LINES = 80
+CODE_PREVIEW_LINES = 20
+MESSAGE_RENDER_BUDGET = 40_000  # characters sent to the browser per message
+CODE_BLOCK_OVERHEAD = 200  # budget charged per rendered block for its widgets
+
+CODE_BLOCK_PATTERN = re.compile(r"```(?P<language>\w+)?\n(?P<code>.*?)\n```", re.DOTALL)
+
+CODE_FILE_EXTENSIONS = {
+    "python": "py",
+    "javascript": "js",
+    "typescript": "ts",
+    "java": "java",
+    "cpp": "cpp",
+    "c": "c",
+    "go": "go",
+    "rust": "rs",
+    "bash": "sh",
+    "sql": "sql",
+    "html": "html",
+    "css": "css",
+    "json": "json",
+    "yaml": "yaml"
+}
+
 def extract_code_blocks(text: str) -> List[Dict[str, str]]:
     """Extract code blocks from markdown text"""
-    pattern = r"```(?P<language>\w+)?\n(?P<code>.*?)\n```"
-    matches = re.finditer(pattern, text, re.DOTALL)
-    return [match.groupdict() for match in matches]
+    return [match.groupdict() for match in CODE_BLOCK_PATTERN.finditer(text)]
 
-def display_message(message: Dict[str, str]):
-    """Display a message in the chat with proper formatting"""
-    with st.chat_message(message["role"]):
-        content = message["content"]
-        
-        # Check for code blocks
-        code_blocks = extract_code_blocks(content)
-        if code_blocks:
-            # Split content by code blocks to handle text and code separately
-            parts = re.split(r"```\w*\n.*?\n```", content, flags=re.DOTALL)
-            
-            for i, part in enumerate(parts):
-                if part.strip():
-                    st.markdown(part)
-                if i < len(code_blocks):
-                    code_block = code_blocks[i]
-                    language = code_block.get("language", "")
-                    st.code(code_block["code"], language=language)
+@st.cache_resource(max_entries=1024, show_spinner=False)
+def split_message(content: str) -> tuple:
+    """Split content into text and code segments as offsets, so nothing is copied.
+
+    Each segment is (kind, start, end, language, digest, line_count); digest and
+    line_count are only set for code segments.
+    """
+    segments = []
+    pos = 0
+    for match in CODE_BLOCK_PATTERN.finditer(content):
+        if match.start() > pos:
+            segments.append(("text", pos, match.start(), None, None, 0))
+        code = match.group("code")
+        start, end = match.span("code")
+        digest = hashlib.sha1(code.encode()).hexdigest()[:16]
+        segments.append(("code", start, end, match.group("language") or "", digest, code.count("\n") + 1))
+        pos = match.end()
+    if pos < len(content):
+        segments.append(("text", pos, len(content), None, None, 0))
+    return tuple(segments)
+
+def render_code_block(content: str, start: int, end: int, language: str, digest: str,
+                      line_count: int, block_key: str, budget: int) -> int:
+    """Render a code block, collapsing large ones to a preview; returns budget used.
+
+    block_key identifies the block within the page and keys its widgets. Nothing
+    beyond the remaining budget is sent, even for an expanded block.
+    """
+    if line_count <= LARGE_CODE_LINES and end - start <= budget:
+        st.code(content[start:end], language=language)
+        return end - start + CODE_BLOCK_OVERHEAD
+
+    expand_key = f"expand_{block_key}"
+    shown_end = end
+    if not st.session_state.get(expand_key):
+        shown_end = start
+        for _ in range(CODE_PREVIEW_LINES):
+            newline = content.find("\n", shown_end, end)
+            if newline == -1:
+                shown_end = end
+                break
+            shown_end = newline + 1
+    shown_end = min(shown_end, start + max(budget, 0))
+    shown = content[start:shown_end].rstrip("\n")
+    st.code(shown, language=language)
+    if shown_end < end:
+        st.caption(f"Showing {len(shown):,} of {end - start:,} characters ({line_count} lines)")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.toggle("Show full code", key=expand_key)
+    with col2:
+        # Download data is served from the media store on click, not sent with the page
+        st.download_button(
+            "⬇️ Download",
+            data=content[start:end],
+            file_name=f"fluxcode_{digest}.{CODE_FILE_EXTENSIONS.get(language.lower(), 'txt')}",
+            mime="text/plain",
+            key=f"download_{block_key}"
+        )
+    return len(shown) + CODE_BLOCK_OVERHEAD
+
+# Attachments: images are downscaled and recompressed, logs have repeated lines
+# collapsed, long text keeps its head and tail, and each prepared file is
+# uploaded once per key to the File API
+ATTACHMENT_TYPES = [
+    "png", "jpg", "jpeg", "webp", "gif",
+    "txt", "log", "md", "py", "js", "ts", "json", "csv", "yaml", "yml", "xml", "html", "css", "sql", "sh"
+]
+IMAGE_TYPES = ("png", "jpg", "jpeg", "webp", "gif")
+LOG_TYPES = ("log", "txt")  # repeated lines are collapsed only in these; code and data keep every line
+IMAGE_MAX_SIDE = int(os.getenv("FLUXCODE_IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = 85
+TEXT_ATTACHMENT_LIMIT = int(os.getenv("FLUXCODE_TEXT_ATTACHMENT_KB", "64")) * 1024
+ATTACHMENT_DIR = os.getenv("FLUXCODE_ATTACHMENT_DIR", os.path.join(tempfile.gettempdir(), "fluxcode_attachments"))
+# The File API deletes uploads after 48 hours; stop reusing them a little earlier
+FILE_REUSE_SECONDS = 47 * 3600
+# Prepared files unused for as long as an upload is reused are deleted, and the
+# least recently used go first once the directory exceeds its size cap
+ATTACHMENT_DIR_LIMIT = int(os.getenv("FLUXCODE_ATTACHMENT_DIR_MB", "512")) * 1024 * 1024
+ATTACHMENT_PRUNE_SECONDS = 600
+
+def prepare_image(data: bytes) -> Tuple[bytes, str]:
+    """Downscale an image to IMAGE_MAX_SIDE and recompress it, keeping the original if smaller"""
+    image = Image.open(io.BytesIO(data))
+    original_format = image.format
+    fits = max(image.size) <= IMAGE_MAX_SIDE
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    if image.mode not in ("RGB", "L"):
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, "white")
+        image.paste(rgba, mask=rgba.split()[-1])
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    prepared = output.getvalue()
+    if fits and original_format in ("PNG", "JPEG", "WEBP") and len(data) <= len(prepared):
+        return data, f"image/{original_format.lower()}"
+    return prepared, "image/jpeg"
+
+def collapse_repeated_lines(lines: List[str]) -> List[str]:
+    """Replace runs of an identical non-blank line with a single note"""
+    collapsed = []
+    previous = None
+    repeats = 0
+    for line in lines:
+        if line == previous and line.strip():
+            repeats += 1
+            continue
+        if repeats:
+            collapsed.append(f"[previous line repeated {repeats} more times]")
+        collapsed.append(line)
+        previous = line
+        repeats = 0
+    if repeats:
+        collapsed.append(f"[previous line repeated {repeats} more times]")
+    return collapsed
+
+def prepare_text(data: bytes, collapse: bool = False) -> bytes:
+    """Optionally collapse repeated lines, then keep the head and tail of text beyond TEXT_ATTACHMENT_LIMIT"""
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    text = "\n".join(collapse_repeated_lines(lines) if collapse else lines)
+    if len(text) > TEXT_ATTACHMENT_LIMIT:
+        # Setup lines sit at the start and failures at the end, so keep a quarter
+        # of the budget for the head and the rest for the tail, on line boundaries
+        head = text[:TEXT_ATTACHMENT_LIMIT // 4]
+        head = head[:head.rfind("\n") + 1]
+        tail = text[-(TEXT_ATTACHMENT_LIMIT - len(head)):]
+        tail = tail[tail.find("\n") + 1:]
+        text = f"{head}[{len(text) - len(head) - len(tail)} characters omitted]\n{tail}"
+    return text.encode()
+
+class AttachmentStore:
+    """Content-addressed prepared attachments and their File API uploads per key.
+
+    Files unused for max_age seconds are deleted, and the least recently used
+    go first while the directory is over max_bytes; file mtimes record last use.
+    """
+
+    def __init__(self, directory: str, max_age: float = FILE_REUSE_SECONDS, max_bytes: int = ATTACHMENT_DIR_LIMIT):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.prepared: Dict[str, tuple] = {}  # sha256 of upload -> attachment
+        self.uploads: Dict[Tuple[str, str], Tuple[Dict, float]] = {}  # (key digest, hash) -> (part, expiry)
+        self.next_prune = 0.0
+        # Files left by an earlier process are subject to the same limits
+        self.prune()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def touch(self, digest: str) -> bool:
+        """Mark a prepared file as used; False if it has been deleted"""
+        try:
+            os.utime(self.path(digest))
+            return True
+        except OSError:
+            return False
+
+    def prune(self):
+        """Delete expired and excess files, and forget the uploads and preparations that went with them"""
+        now = time.time()
+        with self.lock:
+            self.next_prune = now + ATTACHMENT_PRUNE_SECONDS
+            files = []
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            removed = set()
+            for mtime, size, name in files:
+                if mtime > now - self.max_age and total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    continue
+                removed.add(name)
+                total -= size
+            self.uploads = {k: v for k, v in self.uploads.items() if v[1] > now and k[1] not in removed}
+            self.prepared = {k: v for k, v in self.prepared.items() if v[0] not in removed}
+
+    def add(self, name: str, data: bytes) -> tuple:
+        """Prepare an uploaded file once; returns (hash, name, mime_type, original_size, prepared_size)"""
+        if time.time() >= self.next_prune:
+            self.prune()
+        original = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            attachment = self.prepared.get(original)
+            if attachment and self.touch(attachment[0]):
+                return attachment[:1] + (name,) + attachment[2:]
+        extension = name.rsplit(".", 1)[-1].lower()
+        if extension in IMAGE_TYPES:
+            prepared, mime_type = prepare_image(data)
         else:
-            st.markdown(content)
+            prepared, mime_type = prepare_text(data, collapse=extension in LOG_TYPES), "text/plain"
+        digest = hashlib.sha256(prepared).hexdigest()
+        if not self.touch(digest):
+            with open(self.path(digest), "wb") as f:
+                f.write(prepared)
+        attachment = (digest, name, mime_type, len(data), len(prepared))
+        with self.lock:
+            self.prepared[original] = attachment
+        return attachment
+
+    def file_part(self, api_key: str, attachment: tuple) -> Optional[Dict]:
+        """File API reference for an attachment, uploading it under this key only if needed.
+
+        None once the prepared file has been deleted and no upload is left to reuse.
+        """
+        digest, name, mime_type = attachment[:3]
+        cache_key = (hashlib.sha256(api_key.encode()).hexdigest(), digest)
+        with self.lock:
+            cached = self.uploads.get(cache_key)
+        if cached and cached[1] > time.time():
+            self.touch(digest)
+            return cached[0]
+        if not self.touch(digest):
+            return None
+        client = FileServiceClient(client_options={"api_key": api_key})
+        with open(self.path(digest), "rb") as f:
+            uploaded = client.create_file(f, mime_type=mime_type, display_name=name)
+        part = {"file_data": {"mime_type": uploaded.mime_type, "file_uri": uploaded.uri}}
+        with self.lock:
+            self.uploads[cache_key] = (part, time.time() + FILE_REUSE_SECONDS)
+        return part
+
+@st.cache_resource
+def get_attachment_store() -> AttachmentStore:
+    """Process-wide attachment store shared by all sessions"""
+    return AttachmentStore(ATTACHMENT_DIR)
+
+def resolve_attachments(request: Dict, api_key: str) -> Dict[str, Dict]:
+    """File API parts for every attachment a request refers to and the store still has, keyed by hash"""
+    store = get_attachment_store()
+    parts = {}
+    for attachment in request_attachments(request):
+        part = store.file_part(api_key, attachment)
+        if part is not None:
+            parts[attachment[0]] = part
+    return parts
+
+def request_attachments(request: Dict) -> List[tuple]:
+    attachments = [tuple(a) for a in request.get("attachments", [])]
+    for turn in request["history"]:
+        attachments.extend(tuple(p["attachment"]) for p in turn["parts"] if isinstance(p, dict))
+    return attachments
+
+def render_attachments(message: Message):
+    store = get_attachment_store()
+    for digest, name, mime_type, original_size, prepared_size in message.attachments:
+        if mime_type.startswith("image/") and os.path.exists(store.path(digest)):
+            st.image(store.path(digest), width=240)
+        st.caption(f"📎 {name} · {original_size / 1024:.0f} KB → {prepared_size / 1024:.0f} KB sent")
+
+# Sandbox for running generated Python code blocks
+PYTHON_LANGUAGES = ("python", "py", "python3")
+SANDBOX_WORKERS = int(os.getenv("FLUXCODE_SANDBOX_WORKERS", "4"))
+SANDBOX_CPU_SECONDS = int(os.getenv("FLUXCODE_SANDBOX_CPU_SECONDS", "5"))
+SANDBOX_MEMORY_MB = int(os.getenv("FLUXCODE_SANDBOX_MEMORY_MB", "256"))
+SANDBOX_WALL_SECONDS = SANDBOX_CPU_SECONDS * 3
+SANDBOX_MAX_PROCESSES = int(os.getenv("FLUXCODE_SANDBOX_MAX_PROCESSES", "64"))  # RLIMIT_NPROC, counted per user id
+SANDBOX_OUTPUT_LIMIT = 20_000  # characters of output kept per run
+
+# Isolation for ▶️ Run: "bwrap" runs each worker in bubblewrap with no network,
+# no view of the host filesystem beyond system libraries, and an unprivileged
+# uid. "unisolated" runs workers as the app user and is only for trusted
+# single-user installs. Run is hidden when the chosen isolation is unavailable.
+SANDBOX_ISOLATION = os.getenv("FLUXCODE_SANDBOX", "bwrap").lower()
+SANDBOX_BWRAP = shutil.which("bwrap")
+SANDBOX_UID = 65534  # nobody
+SANDBOX_SYSTEM_PATHS = ("/usr", "/bin", "/sbin", "/lib", "/lib32", "/lib64", "/etc/alternatives", "/etc/localtime")
+
+# Runs inside each worker: blocks on stdin until given code, then applies
+# resource limits and executes it
+SANDBOX_WORKER_SOURCE = """
+import sys
+code = sys.stdin.read()
+cpu_seconds, memory_mb, max_processes = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+try:
+    import resource
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024,) * 2)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (16 * 1024 * 1024,) * 2)
+    resource.setrlimit(resource.RLIMIT_NPROC, (max_processes, max_processes))
+except (ImportError, ValueError, OSError):
+    pass
+sys.argv = ["main.py"]
+import traceback
+try:
+    exec(compile(code, "main.py", "exec"), {"__name__": "__main__"})
+except SystemExit:
+    raise
+except BaseException as e:
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+class SandboxRun:
+    """One execution in a sandbox worker, collecting its output as it streams"""
+
+    def __init__(self, proc: subprocess.Popen, workdir: str, code: str):
+        self.proc = proc
+        self.workdir = workdir
+        self.chunks = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.returncode = None
+        self.timed_out = False
+        readers = [
+            threading.Thread(target=self._read, args=(proc.stdout,), daemon=True),
+            threading.Thread(target=self._read, args=(proc.stderr,), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=self._wait, args=(readers,), daemon=True).start()
+        try:
+            proc.stdin.write(code.encode())
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    def _read(self, stream):
+        while True:
+            data = os.read(stream.fileno(), 4096)
+            if not data:
+                break
+            with self.lock:
+                if self.size < SANDBOX_OUTPUT_LIMIT:
+                    text = data.decode(errors="replace")
+                    self.chunks.append(text)
+                    self.size += len(text)
+
+    def _wait(self, readers):
+        try:
+            self.proc.wait(timeout=SANDBOX_WALL_SECONDS)
+        except subprocess.TimeoutExpired:
+            self.timed_out = True
+            kill_process_group(self.proc)
+            self.proc.wait()
+        for reader in readers:
+            reader.join()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        self.returncode = self.proc.returncode
+
+    @property
+    def done(self) -> bool:
+        return self.returncode is not None
+
+    def output(self) -> str:
+        with self.lock:
+            text = "".join(self.chunks)
+        if self.size >= SANDBOX_OUTPUT_LIMIT:
+            text = text[:SANDBOX_OUTPUT_LIMIT] + "\n… output truncated"
+        if self.timed_out:
+            text += f"\n… stopped after {SANDBOX_WALL_SECONDS}s"
+        return text
+
+def sandbox_available() -> bool:
+    """Whether ▶️ Run can be offered with the configured isolation"""
+    if SANDBOX_ISOLATION == "unisolated":
+        return True
+    return SANDBOX_ISOLATION == "bwrap" and SANDBOX_BWRAP is not None and os.name == "posix"
+
+def sandbox_command(workdir: str) -> Tuple[List[str], str]:
+    """Worker command line and the working directory as the worker sees it"""
+    worker = [
+        sys.executable, "-I", "-u", "-c", SANDBOX_WORKER_SOURCE,
+        str(SANDBOX_CPU_SECONDS), str(SANDBOX_MEMORY_MB), str(SANDBOX_MAX_PROCESSES)
+    ]
+    if SANDBOX_ISOLATION != "bwrap":
+        return worker, workdir
+    # New user, pid, network, ipc and uts namespaces; only system libraries,
+    # the Python installation and the run's own directory are visible
+    command = [
+        SANDBOX_BWRAP, "--unshare-all", "--unshare-user", "--die-with-parent", "--new-session",
+        "--uid", str(SANDBOX_UID), "--gid", str(SANDBOX_UID), "--cap-drop", "ALL",
+        "--proc", "/proc", "--dev", "/dev", "--tmpfs", "/tmp"
+    ]
+    for path in SANDBOX_SYSTEM_PATHS + tuple(sorted({sys.base_prefix, sys.prefix})):
+        command += ["--ro-bind-try", path, path]
+    command += ["--bind", workdir, "/work", "--chdir", "/work"]
+    return command + worker, "/work"
+
+def kill_process_group(proc: subprocess.Popen):
+    """Kill a worker and anything it spawned"""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+class SandboxPool:
+    """Pre-started, single-use Python workers so runs skip interpreter startup"""
+
+    def __init__(self, size: int):
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self._spawn()
+        atexit.register(self.close)
+
+    def _spawn(self):
+        workdir = tempfile.mkdtemp(prefix="fluxcode_run_")
+        command, home = sandbox_command(workdir)
+        proc = subprocess.Popen(
+            command,
+            cwd=workdir,
+            # A minimal environment keeps API keys and other secrets out of the sandbox
+            env={"PATH": os.environ.get("PATH", ""), "HOME": home, "TMPDIR": home, "LANG": "C.UTF-8"},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if os.name == "nt" else subprocess.PIPE,
+            start_new_session=True
+        )
+        self.idle.put((proc, workdir))
+
+    def run(self, code: str) -> SandboxRun:
+        """Start code on a warm worker and replace the worker in the background"""
+        try:
+            proc, workdir = self.idle.get_nowait()
+        except queue.Empty:
+            self._spawn()
+            proc, workdir = self.idle.get()
+        threading.Thread(target=self._spawn, daemon=True).start()
+        return SandboxRun(proc, workdir, code)
+
+    def close(self):
+        while not self.idle.empty():
+            proc, workdir = self.idle.get_nowait()
+            kill_process_group(proc)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+@st.cache_resource
+def get_sandbox_pool() -> SandboxPool:
+    """Process-wide pool of warm sandbox workers"""
+    return SandboxPool(SANDBOX_WORKERS)
+
+def run_status(returncode: int) -> str:
+    if returncode == 0:
+        return "✅ Exited with code 0"
+    if returncode < 0:
+        return f"❌ Killed by signal {-returncode} (time or memory limit exceeded)"
+    return f"❌ Exited with code {returncode}"
+
+def render_run_result(result: Dict):
+    st.caption(run_status(result["returncode"]))
+    if result["output"]:
+        st.code(result["output"], language="text")
+
+def render_run_controls(content: str, start: int, end: int, result_key: str, run_now: bool):
+    """Show the last result of a Python block and start a run if requested.
+
+    Returns (run, placeholder) when a run was started so the caller can stream it.
+    """
+    clicked = st.button("▶️ Run", key=f"run_{result_key}")
+    placeholder = st.empty()
+    if not (clicked or run_now):
+        result = st.session_state.run_results.get(result_key)
+        if result is not None:
+            with placeholder.container():
+                render_run_result(result)
+        return None
+    return get_sandbox_pool().run(content[start:end]), placeholder
+
+def stream_runs(runs: list):
+    """Stream the output of concurrent runs into their placeholders until all finish"""
+    while runs:
+        for result_key, run, placeholder in list(runs):
+            if run.done:
+                result = {"output": run.output(), "returncode": run.returncode}
+                st.session_state.run_results[result_key] = result
+                with placeholder.container():
+                    render_run_result(result)
+                if result["returncode"] != 0 and st.session_state.debug_mode and st.session_state.run_feedback:
+                    # Handed to the next Debug Mode prompt
+                    report = f"{run_status(result['returncode'])}\n{result['output']}".strip()
+                    if st.session_state.pending_run_error:
+                        report = st.session_state.pending_run_error + "\n\n" + report
+                    st.session_state.pending_run_error = report[-4000:]
+                runs.remove((result_key, run, placeholder))
+            else:
+                placeholder.code(run.output() or "Running…", language="text")
+        time.sleep(0.1)
+
+def display_message(message: Message):
+    """Display a message in the chat with proper formatting"""
+    with st.chat_message(message.role):
+        content = message.content
+        budget = MESSAGE_RENDER_BUDGET
+        if message.attachments:
+            render_attachments(message)
+        truncated = False
+        segments = split_message(content)
+        runs = []
+        
+        runnable = message.role == "assistant" and sandbox_available()
+        python_blocks = sum(1 for s in segments if s[0] == "code" and s[3].lower() in PYTHON_LANGUAGES) if runnable else 0
+        run_all = python_blocks > 1 and st.button("▶️ Run all", key=f"run_all_{message.id}")
+        
+        for position, (kind, start, end, language, digest, line_count) in enumerate(segments):
+            if budget <= 0:
+                # Everything after this point is only available through the download
+                truncated = True
+                break
+            if kind == "code":
+                # Identical blocks in one answer share a digest, so the position keeps keys unique
+                block_key = f"{message.id}_{position}_{digest}"
+                budget -= render_code_block(content, start, end, language, digest, line_count, block_key, budget)
+                if runnable and language.lower() in PYTHON_LANGUAGES:
+                    started = render_run_controls(content, start, end, block_key, run_all)
+                    if started:
+                        runs.append((block_key, *started))
+            elif content[start:end].strip():
+                if end - start > budget:
+                    if budget > 0:
+                        st.markdown(content[start:start + budget])
+                    budget = 0
+                    truncated = True
+                    continue
+                st.markdown(content[start:end])
+                budget -= end - start
+        
+        # Blocks started together run in parallel on separate workers
+        stream_runs(runs)
+        
+        if message.alternatives:
+            alternatives = message.alternatives
+            current = next((i for i, alt in enumerate(alternatives) if alt == content), 0)
+            alternative_key = f"alternative_{message.id}_{len(alternatives)}"
+            # Only an actual click selects, so equal texts can never trigger a rerun loop
+            st.radio(
+                "Alternative:",
+                range(len(alternatives)),
+                index=current,
+                format_func=lambda i: f"{i + 1}",
+                horizontal=True,
+                key=alternative_key,
+                on_change=select_alternative,
+                args=(message.index, alternative_key)
+            )
+        
+        if truncated:
+            st.caption("Response shortened for display.")
+            st.download_button(
+                "⬇️ Download full response",
+                data=content,
+                file_name=f"fluxcode_{message.id}.md",
+                mime="text/markdown",
+                key=f"download_{message.id}"
+            )
         
         # Add message actions
-        if message["role"] == "assistant":
+        if message.role == "assistant":
             with st.expander("Message Actions"):
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button("📋 Copy", key=f"copy_{message['id']}"):
+                    if st.button("📋 Copy", key=f"copy_{message.id}"):
                         st.session_state.clipboard = content
                         st.toast("Copied to clipboard!")
                 with col2:
-                    if st.button("🔁 Regenerate", key=f"regenerate_{message['id']}"):
-                        # Implement regeneration logic here
-                        pass
+                    # Answers in a Patch Mode conversation have edited the working file,
+                    # and later versions build on them, so they cannot be swapped out
+                    patched = get_working_file() is not None
+                    if st.button(
+                        "🔁 Regenerate",
+                        key=f"regenerate_{message.id}",
+                        disabled=patched,
+                        help="Unavailable once a conversation has a working file; restore a version and ask again instead" if patched else None
+                    ):
+                        with st.spinner(f"Generating {REGENERATE_CANDIDATES} alternatives..."):
+                            regenerated = regenerate_message(message, st.session_state.api_key)
+                        # Rerunning would discard the error or notice shown by a failed attempt
+                        if regenerated:
+                            st.rerun()
+
+# Versions of the working file kept per conversation
+WORKING_FILE_HISTORY = 20
 
-def generate_response(prompt: str, api_key: str) -> str:
+SEARCH_REPLACE_PATTERN = re.compile(
+    r"^<<<<<<< SEARCH\n(?P<search>.*?)^=======\n(?P<replace>.*?)^>>>>>>> REPLACE$",
+    re.DOTALL | re.MULTILINE
+)
+DIFF_BLOCK_PATTERN = re.compile(r"```diff\n(?P<diff>.*?)\n```", re.DOTALL)
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+PATCH_INSTRUCTIONS = """We are iterating on the working file below (version {version}).
+Do not repeat the whole file. Reply with only the changes, as one or more edit blocks:
+
+<<<<<<< SEARCH
+exact lines currently in the file
+=======
+replacement lines
+>>>>>>> REPLACE
+
+Each SEARCH section must match the file exactly and appear in it only once.
+A unified diff in a ```diff block is also accepted.
+
+Working file:
+```{language}
+{content}
+```"""
+
+# Version bodies live in a backend log per conversation; session state only keeps
+# {"language", "logged"} so the persisted snapshot stays small
+def working_file_key(conv_id: str) -> str:
+    return f"{st.session_state.session_id}:{conv_id}:file"
+
+def get_working_file() -> Optional[Dict]:
+    """Working file of the current conversation, if one has been set, with its recent versions"""
+    conv_id = st.session_state.current_conversation_id
+    meta = st.session_state.working_files.get(conv_id)
+    if meta is None:
+        return None
+    versions = st.session_state.working_file_versions.get(conv_id)
+    if versions is None:
+        entries = get_state_backend().read_log(working_file_key(conv_id))
+        versions = [json.loads(e) for e in entries[-WORKING_FILE_HISTORY:]]
+        st.session_state.working_file_versions[conv_id] = versions
+    return {"language": meta["language"], "versions": versions}
+
+def set_working_file(content: str, language: str):
+    """Record a new version of the current conversation's working file"""
+    conv_id = st.session_state.current_conversation_id
+    versions = get_working_file()["versions"] if conv_id in st.session_state.working_files else []
+    meta = st.session_state.working_files.setdefault(conv_id, {"language": language, "logged": 0})
+    meta["language"] = language or meta["language"]
+    versions.append(content)
+    del versions[:-WORKING_FILE_HISTORY]
+    st.session_state.working_file_versions[conv_id] = versions
+
+    # Only the new version is written; the log is cut back once it holds twice the history
+    backend = get_state_backend()
+    key = working_file_key(conv_id)
+    backend.append_log(key, [json.dumps(content)])
+    meta["logged"] += 1
+    if meta["logged"] > 2 * WORKING_FILE_HISTORY:
+        backend.replace_log(key, [json.dumps(v) for v in versions])
+        meta["logged"] = len(versions)
+
+def drop_working_file(conv_id: str):
+    if st.session_state.working_files.pop(conv_id, None) is not None:
+        get_state_backend().delete_log(working_file_key(conv_id))
+    st.session_state.working_file_versions.pop(conv_id, None)
+
+def apply_search_replace(content: str, edits: list) -> str:
+    """Apply SEARCH/REPLACE edits; each search text must occur exactly once"""
+    for search, replace in edits:
+        count = content.count(search)
+        if count != 1:
+            snippet = search.strip().splitlines()[0] if search.strip() else "(empty)"
+            raise ValueError(f"SEARCH text {'not found' if count == 0 else 'is ambiguous'}: {snippet}")
+        content = content.replace(search, replace, 1)
+    return content
+
+def apply_unified_diff(content: str, diff: str) -> str:
+    """Apply a unified diff, locating each hunk by its context nearest the stated line"""
+    hunks = []
+    for line in diff.split("\n"):
+        header = HUNK_HEADER_PATTERN.match(line)
+        if header:
+            hunks.append((int(header.group(1)), [], []))
+        elif hunks and not line.startswith("\\"):
+            # File headers (---/+++) only precede the first hunk; inside hunks
+            # such lines are removals of "--..." or additions of "++..." lines
+            _, old, new = hunks[-1]
+            marker, text = (line[0], line[1:]) if line else (" ", "")
+            if marker in " -":
+                old.append(text)
+            if marker in " +":
+                new.append(text)
+    if not hunks:
+        raise ValueError("diff contains no hunks")
+
+    source = content.split("\n")
+    result = []
+    pos = 0
+    for start, old, new in hunks:
+        if not old:
+            index = min(max(start, pos), len(source))
+        else:
+            matches = [
+                i for i in range(pos, len(source) - len(old) + 1)
+                if source[i:i + len(old)] == old
+            ]
+            if not matches:
+                raise ValueError(f"hunk at line {start} does not match the working file")
+            index = min(matches, key=lambda i: abs(i - (start - 1)))
+        result.extend(source[pos:index])
+        result.extend(new)
+        pos = index + len(old)
+    result.extend(source[pos:])
+    return "\n".join(result)
+
+def apply_edits(content: str, response: str) -> Optional[str]:
+    """Apply the edits in a response to content; None if the response has no edits"""
+    diff = DIFF_BLOCK_PATTERN.search(response)
+    if diff:
+        return apply_unified_diff(content, diff.group("diff"))
+    # Drop the newline that precedes each marker line so edits also match at end of file
+    edits = [
+        (m.group("search")[:-1], m.group("replace")[:-1])
+        for m in SEARCH_REPLACE_PATTERN.finditer(response)
+    ]
+    if edits:
+        return apply_search_replace(content, edits)
+    return None
+
+def largest_code_block(text: str) -> Optional[Dict[str, str]]:
+    blocks = extract_code_blocks(text)
+    return max(blocks, key=lambda b: len(b["code"])) if blocks else None
+
+def update_working_file(prompt: str, response: str, api_key: str) -> str:
+    """Apply a patch-mode response to the working file, regenerating in full if the patch fails.
+
+    Returns the response to keep in the transcript.
+    """
+    working_file = get_working_file()
+    if working_file is None:
+        block = largest_code_block(response)
+        if block:
+            set_working_file(block["code"], block["language"] or "")
+        return response
+
+    try:
+        updated = apply_edits(working_file["versions"][-1], response)
+    except ValueError as e:
+        st.warning(f"Patch did not apply ({e}); regenerating the full file")
+        full_response = generate_response(prompt, api_key, allow_edits=False)
+        block = largest_code_block(full_response or "")
+        if block is None:
+            return response
+        set_working_file(block["code"], block["language"] or "")
+        return full_response
+
+    if updated is None:
+        # No edit blocks; accept a full rewrite if the model sent one anyway
+        block = largest_code_block(response)
+        if block:
+            set_working_file(block["code"], block["language"] or "")
+    else:
+        set_working_file(updated, working_file["language"])
+        st.toast(f"Applied edits to working file (version {len(working_file['versions'])})")
+    return response
+
+def display_working_file():
+    """Show the current working file with its version history"""
+    working_file = get_working_file()
+    if working_file is None:
+        return
+    versions = working_file["versions"]
+    with st.expander(f"📄 Working file — version {len(versions)}"):
+        selected = st.selectbox(
+            "Version:",
+            range(len(versions), 0, -1),
+            format_func=lambda v: f"v{v}",
+            # A new version resets the selection to the current one
+            key=f"working_file_version_{len(versions)}"
+        )
+        content = versions[selected - 1]
+        digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+        render_code_block(
+            content, 0, len(content), working_file["language"], digest,
+            content.count("\n") + 1, f"working_file_{digest}", MESSAGE_RENDER_BUDGET
+        )
+        if selected != len(versions) and st.button("↩️ Restore this version"):
+            set_working_file(content, working_file["language"])
+            st.rerun()
+
+# Shared key pool: GOOGLE_API_KEYS="key1,key2:2" (optional weight after a colon)
+KEY_POOL_SPEC = os.getenv("GOOGLE_API_KEYS", "")
+KEY_RPM_LIMIT = int(os.getenv("FLUXCODE_KEY_RPM", "15"))
+KEY_WINDOW_SECONDS = 60
+# Seconds a key sits out after the API rejects it with this HTTP status
+QUARANTINE_SECONDS = {429: 60, 403: 600}
+# Optional endpoint override, e.g. a local fake server enforcing per-key quotas
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+class PooledKey:
+    """Load, quota and error tracking for one API key"""
+
+    def __init__(self, key: str, weight: float):
+        self.key = key
+        self.weight = weight
+        self.in_flight = 0
+        self.started = deque()   # request start times within the rolling window
+        self.outcomes = deque()  # (time, ok) within the rolling window
+        self.quarantined_until = 0.0
+        self.total_requests = 0
+        self.total_errors = 0
+
+    def prune(self, now: float):
+        cutoff = now - KEY_WINDOW_SECONDS
+        while self.started and self.started[0] < cutoff:
+            self.started.popleft()
+        while self.outcomes and self.outcomes[0][0] < cutoff:
+            self.outcomes.popleft()
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def score(self) -> float:
+        """Lower is better: in-flight and recent requests relative to weight, discounted by errors"""
+        load = self.in_flight + len(self.started)
+        return (load + 1) / (self.weight * max(1.0 - self.error_rate(), 0.05))
+
+class ApiKeyPool:
+    """Weighted least-loaded selection over several Gemini API keys"""
+
+    def __init__(self, spec: str):
+        self.lock = threading.Lock()
+        self.keys: List[PooledKey] = []
+        for item in spec.split(","):
+            key, _, weight = item.strip().partition(":")
+            if key and key not in [k.key for k in self.keys]:
+                self.keys.append(PooledKey(key, float(weight or 1)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self) -> PooledKey:
+        """Reserve the best available key; callers must release() it"""
+        with self.lock:
+            now = time.time()
+            for pooled in self.keys:
+                pooled.prune(now)
+            healthy = [k for k in self.keys if k.quarantined_until <= now]
+            under_quota = [k for k in healthy if len(k.started) < KEY_RPM_LIMIT]
+            if under_quota or healthy:
+                pooled = min(under_quota or healthy, key=lambda k: k.score())
+            else:
+                pooled = min(self.keys, key=lambda k: k.quarantined_until)
+            pooled.in_flight += 1
+            pooled.started.append(now)
+            pooled.total_requests += 1
+            return pooled
+
+    def release(self, pooled: PooledKey, status: Optional[int] = None):
+        """Record the outcome of a request; status is the HTTP error status, None on success"""
+        with self.lock:
+            now = time.time()
+            pooled.in_flight -= 1
+            # A rejected request (400) says nothing about the key's health
+            pooled.outcomes.append((now, status in (None, 400)))
+            if status is not None:
+                pooled.total_errors += 1
+                if status in QUARANTINE_SECONDS:
+                    pooled.quarantined_until = now + QUARANTINE_SECONDS[status]
+
+    def metrics(self) -> List[Dict]:
+        with self.lock:
+            now = time.time()
+            rows = []
+            for pooled in self.keys:
+                pooled.prune(now)
+                rows.append({
+                    "key": f"…{pooled.key[-4:]}",
+                    "weight": pooled.weight,
+                    "in_flight": pooled.in_flight,
+                    "rpm": len(pooled.started),
+                    "error_rate": round(pooled.error_rate(), 2),
+                    "quarantined_s": max(0, int(pooled.quarantined_until - now)),
+                    "requests": pooled.total_requests,
+                    "errors": pooled.total_errors
+                })
+            return rows
+
+@st.cache_resource
+def get_key_pool() -> ApiKeyPool:
+    """Process-wide key pool from GOOGLE_API_KEYS, falling back to GOOGLE_API_KEY"""
+    return ApiKeyPool(KEY_POOL_SPEC or os.getenv("GOOGLE_API_KEY", ""))
+
+@st.cache_resource
+def get_generative_client(api_key: str):
+    """Per-key Gemini client; genai.configure() is process-global and unsafe across sessions"""
+    options = {"api_key": api_key}
+    if GEMINI_API_ENDPOINT:
+        options["api_endpoint"] = GEMINI_API_ENDPOINT
+        return glm.GenerativeServiceClient(client_options=options, transport="rest")
+    return glm.GenerativeServiceClient(client_options=options)
+
+def get_error_status(error: Exception) -> Optional[int]:
+    """HTTP status carried by a Google API error, if any"""
+    try:
+        return int(getattr(error, "code", None))
+    except (TypeError, ValueError):
+        return None
+
+def is_rejected_request(error: Exception) -> bool:
+    """The request itself was refused: a 400 from the API, or a ValueError raised locally by the client library"""
+    return get_error_status(error) == 400 or isinstance(error, ValueError)
+
+def failure_status(error: Exception) -> int:
+    """Status to record for a failed request"""
+    return get_error_status(error) or (400 if is_rejected_request(error) else 500)
+
+# Answers requested per Regenerate click, in a single call where the model allows
+REGENERATE_CANDIDATES = 3
+
+# Generation backend: "live" calls Gemini, "record" also writes every exchange
+# to the cassette, "replay" serves the cassette offline without an API key
+GENERATION_BACKEND = os.getenv("FLUXCODE_BACKEND", "live").lower()
+CASSETTE_PATH = os.getenv("FLUXCODE_CASSETTE", "fluxcode_cassette.jsonl")
+REPLAY_SPEED = float(os.getenv("FLUXCODE_REPLAY_SPEED", "1"))
+
+def build_history(messages) -> List[Dict]:
+    """Convert messages to the Gemini chat history format.
+
+    Attachments stay as {"attachment": ...} placeholders until a key is chosen,
+    since File API uploads belong to the key that made them.
+    """
+    return [
+        {
+            "role": "user" if msg.role == "user" else "model",
+            "parts": [msg.content] + [{"attachment": list(a)} for a in msg.attachments]
+        }
+        for msg in messages
+    ]
+
+def candidate_text(candidate) -> str:
+    return "".join(part.text for part in candidate.content.parts if getattr(part, "text", None))
+
+def request_key(request: Dict) -> str:
+    """Stable identity of a generation request, used to match cassette entries"""
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+class ReplayedError(Exception):
+    """An API error played back from a cassette, carrying the original HTTP status"""
+
+    def __init__(self, message: str, code: Optional[int]):
+        super().__init__(message)
+        self.code = code
+
+class LiveBackend:
+    """Sends requests to Gemini.
+
+    generate() yields streamed text chunks for a single candidate, or one
+    complete text per candidate when several are requested. files maps
+    attachment hashes to File API parts uploaded under the client's key.
+    """
+    requires_key = True
+
+    def generate(self, request: Dict, client, files: Dict) -> Iterator[str]:
+        def resolve(parts):
+            # Attachments pruned from the store are replaced by a note
+            return [
+                files.get(p["attachment"][0], f"[attachment {p['attachment'][1]} is no longer available]")
+                if isinstance(p, dict) else p
+                for p in parts
+            ]
+
+        model = genai.GenerativeModel(request["model"])
+        model._client = client
+        history = [{"role": turn["role"], "parts": resolve(turn["parts"])} for turn in request["history"]]
+        content = request["prompt"]
+        if request.get("attachments"):
+            content = resolve([content] + [{"attachment": a} for a in request["attachments"]])
+        if request["candidate_count"] == 1:
+            chat = model.start_chat(history=history)
+            for chunk in chat.send_message(content, stream=True):
+                if chunk.candidates:
+                    yield candidate_text(chunk.candidates[0])
+        else:
+            # ChatSession refuses candidate_count > 1 locally, so send the turns directly
+            contents = history + [{"role": "user", "parts": content if isinstance(content, list) else [content]}]
+            config = {"candidate_count": request["candidate_count"]}
+            response = model.generate_content(contents, generation_config=config)
+            for candidate in response.candidates:
+                yield candidate_text(candidate)
+
+class RecordingBackend:
+    """Wraps another backend and appends every request, chunk timing and error to a cassette"""
+    requires_key = True
+
+    def __init__(self, inner, path: str):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+
+    def generate(self, request, client, files):
+        start = time.monotonic()
+        chunks = []
+        try:
+            for text in self.inner.generate(request, client, files):
+                chunks.append([round(time.monotonic() - start, 4), text])
+                yield text
+        except Exception as e:
+            self._write(request, chunks, {"status": get_error_status(e), "message": str(e)})
+            raise
+        self._write(request, chunks, None)
+
+    def _write(self, request, chunks, error):
+        entry = {"key": request_key(request), "request": request, "chunks": chunks, "error": error}
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+class ReplayBackend:
+    """Serves recorded responses deterministically; speed scales the recorded chunk delays (0 = instant)"""
+    requires_key = False
+
+    def __init__(self, path: str, speed: float):
+        self.path = path
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries: Dict[str, list] = {}
+        self.cursors: Dict[str, int] = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+
+    def generate(self, request, client, files):
+        key = request_key(request)
+        recorded = self.entries.get(key)
+        if not recorded:
+            raise LookupError(f"No recorded response for this request in {self.path}")
+        # Identical requests replay their recordings in order, then cycle
+        with self.lock:
+            cursor = self.cursors.get(key, 0)
+            self.cursors[key] = cursor + 1
+        entry = recorded[cursor % len(recorded)]
+        previous = 0.0
+        for offset, text in entry["chunks"]:
+            if self.speed > 0:
+                time.sleep(max(offset - previous, 0) / self.speed)
+            previous = offset
+            yield text
+        if entry["error"]:
+            raise ReplayedError(entry["error"]["message"], entry["error"]["status"])
+
+@st.cache_resource
+def get_generation_backend():
+    """Process-wide generation backend selected by FLUXCODE_BACKEND"""
+    if GENERATION_BACKEND == "replay":
+        return ReplayBackend(CASSETTE_PATH, REPLAY_SPEED)
+    if GENERATION_BACKEND == "record":
+        return RecordingBackend(LiveBackend(), CASSETTE_PATH)
+    return LiveBackend()
+
+def send_chat(backend, client, request: Dict, files: Optional[Dict] = None, tracked=None) -> List[str]:
+    """Run a request through a backend and return the text of each candidate.
+
+    tracked is the TrackedRequest reporting this call to the operations dashboard.
+    """
+    texts = []
+    try:
+        for text in backend.generate(request, client, files or {}):
+            if tracked is not None and not texts:
+                tracked.first_chunk()
+            texts.append(text)
+    except Exception as e:
+        if tracked is not None:
+            tracked.finish(failure_status(e))
+        raise
+    if tracked is not None:
+        tracked.finish()
+    return ["".join(texts)] if request["candidate_count"] == 1 else texts
+
+def make_request(prompt: str, history: List[Dict], candidate_count: int = 1, attachments: tuple = (),
+                 model: Optional[str] = None) -> Dict:
+    request = {
+        "model": model or st.session_state.current_model,
+        "history": history,
+        "prompt": prompt,
+        "candidate_count": candidate_count
+    }
+    if attachments:
+        request["attachments"] = [list(a) for a in attachments]
+    return request
+
+def request_completion(prompt: str, history: List[Dict], api_key: str, candidate_count: int = 1,
+                       attachments: tuple = (), model: Optional[str] = None) -> List[str]:
+    """Send a formatted prompt, using the sidebar key or else the shared key pool.
+
+    A pooled key that is rate limited is quarantined and the request moves to
+    another key; other errors are raised to the caller.
+    """
+    backend = get_generation_backend()
+    request = make_request(prompt, history, candidate_count, attachments, model)
+    pool = get_key_pool()
+    if not backend.requires_key and not api_key and not len(pool):
+        return send_chat(backend, None, request, tracked=track_request(request))
+
+    attempts = 1 if api_key else max(len(pool), 1)
+    for attempt in range(attempts):
+        pooled = None if api_key else pool.acquire()
+        try:
+            key = api_key or pooled.key
+            if backend.requires_key:
+                client, files = get_generative_client(key), resolve_attachments(request, key)
+            else:
+                # Replay needs no client or uploads, but placeholder keys still rotate
+                # and get quarantined by recorded 429/403 errors
+                client, files = None, {}
+            texts = send_chat(backend, client, request, files, track_request(request))
+        except Exception as e:
+            status = failure_status(e)
+            if pooled is not None:
+                pool.release(pooled, status)
+                if status in QUARANTINE_SECONDS and attempt < attempts - 1:
+                    continue
+            raise
+        if pooled is not None:
+            pool.release(pooled)
+        return texts
+
+def request_concurrent_completions(prompt: str, history: List[Dict], api_key: str, count: int,
+                                   attachments: tuple = (), model: Optional[str] = None) -> List[str]:
+    """Fallback for models without candidate_count: the same request on several keys at once"""
+    backend = get_generation_backend()
+    request = make_request(prompt, history, attachments=attachments, model=model)
+    pool = get_key_pool()
+    pooled_keys = not api_key and (backend.requires_key or len(pool))
+    leases = [pool.acquire() if pooled_keys else None for _ in range(count)]
+    keys = [api_key or (pooled.key if pooled else None) for pooled in leases]
+    try:
+        calls = [
+            (get_generative_client(key), resolve_attachments(request, key)) if backend.requires_key else (None, {})
+            for key in keys
+        ]
+    except Exception:
+        for pooled in leases:
+            if pooled is not None:
+                pool.release(pooled, 500)
+        raise
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [
+            executor.submit(send_chat, backend, client, request, files, track_request(request))
+            for client, files in calls
+        ]
+    texts = []
+    for pooled, future in zip(leases, futures):
+        error = future.exception()
+        if pooled is not None:
+            pool.release(pooled, None if error is None else failure_status(error))
+        if error is None:
+            texts.extend(future.result())
+    if not texts:
+        raise futures[0].exception()
+    return texts
+
+# Automatic model routing: a cheap local score of how demanding a turn is picks
+# the fast or the strong model, and outcomes move the threshold between them
+AUTO_MODEL = "Auto"
+AUTO_ROUTES = {"fast": "gemini-2.0-flash", "strong": "gemini-1.5-pro"}
+ROUTER_THRESHOLD = float(os.getenv("FLUXCODE_AUTO_THRESHOLD", "1.0"))
+ROUTER_THRESHOLD_RANGE = (0.2, 5.0)
+ROUTER_STEP = 0.05
+ROUTER_RETRY_RATE = (0.05, 0.3)  # bounds on the fast-route retry rate the threshold aims for
+ROUTER_DEFAULT_RETRY_RATE = 0.1  # until both routes have latency samples
+ROUTER_WINDOW = 50  # latencies kept per route
+
+def turn_complexity(prompt: str, history: list, attachments: tuple = ()) -> float:
+    """Cheap local estimate of how demanding a turn is; the router's threshold starts at 1.0"""
+    code_lines = sum(block["code"].count("\n") + 1 for block in extract_code_blocks(prompt))
+    if st.session_state.patch_mode and get_working_file():
+        code_lines += get_working_file()["versions"][-1].count("\n") + 1
+    score = len(prompt) / 2000 + code_lines / 60 + min(len(history), 40) / 20 + 0.25 * len(attachments)
+    score += 0.3 * st.session_state.debug_mode + 0.3 * st.session_state.patch_mode
+    score += 0.2 * st.session_state.code_gen_mode + 0.1 * st.session_state.explain_mode
+    if st.session_state.response_style == "Detailed":
+        score += 0.2
+    return score
+
+class ModelRouter:
+    """Threshold on turn complexity between the fast and strong model, shared by all sessions.
+
+    Every fast answer raises the threshold a little and every fast answer that
+    fails or is regenerated lowers it, so the fast route settles at a target
+    retry rate. The target is the break-even point where a retry (fast, then
+    strong) costs as much latency as going straight to the strong model.
+    """
+
+    def __init__(self, threshold: float):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.latencies = {route: deque(maxlen=ROUTER_WINDOW) for route in AUTO_ROUTES}
+        self.totals = {route: {"turns": 0, "errors": 0, "retries": 0} for route in AUTO_ROUTES}
+
+    def route(self, score: float) -> str:
+        return "strong" if score >= self.threshold else "fast"
+
+    def median_latency(self, route: str) -> Optional[float]:
+        latencies = sorted(self.latencies[route])
+        return latencies[len(latencies) // 2] if latencies else None
+
+    def target_retry_rate(self) -> float:
+        with self.lock:
+            return self._target_retry_rate()
+
+    def _target_retry_rate(self) -> float:
+        fast, strong = self.median_latency("fast"), self.median_latency("strong")
+        if not fast or not strong:
+            return ROUTER_DEFAULT_RETRY_RATE
+        return min(max(1 - fast / strong, ROUTER_RETRY_RATE[0]), ROUTER_RETRY_RATE[1])
+
+    def _move(self, factor: float):
+        self.threshold = min(max(self.threshold * factor, ROUTER_THRESHOLD_RANGE[0]), ROUTER_THRESHOLD_RANGE[1])
+
+    def record(self, route: str, latency: float, ok: bool):
+        """Outcome of a routed turn"""
+        with self.lock:
+            self.totals[route]["turns"] += 1
+            if ok:
+                self.latencies[route].append(latency)
+            else:
+                self.totals[route]["errors"] += 1
+            if route == "fast":
+                self._move(1 + ROUTER_STEP * self._target_retry_rate() if ok else 1 - ROUTER_STEP)
+
+    def retried(self, route: str):
+        """A routed answer was regenerated, so its route was not good enough"""
+        with self.lock:
+            self.totals[route]["retries"] += 1
+            if route == "fast":
+                self._move(1 - ROUTER_STEP)
+
+    def metrics(self) -> List[Dict]:
+        with self.lock:
+            return [
+                {
+                    "route": route,
+                    "model": AUTO_ROUTES[route],
+                    "p50_s": round(self.median_latency(route), 2) if self.latencies[route] else None,
+                    **totals
+                }
+                for route, totals in self.totals.items()
+            ]
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Process-wide router behind the Auto model option"""
+    return ModelRouter(ROUTER_THRESHOLD)
+
+def resolve_model(prompt: str, history: list, attachments: tuple = ()) -> Tuple[str, Optional[str]]:
+    """Model for this turn and, under Auto, the route that picked it"""
+    route = None
+    if st.session_state.current_model == AUTO_MODEL:
+        route = get_model_router().route(turn_complexity(prompt, history, attachments))
+    st.session_state.last_route = route
+    return (AUTO_ROUTES[route] if route else st.session_state.current_model), route
+
+def generate_response(prompt: str, api_key: str, allow_edits: bool = True) -> str:
     """Generate a response from Gemini API with full conversation history."""
+    route = None
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(st.session_state.current_model)
-
-        # Build history from previous messages (all except the latest user turn)
-        history = []
-        for msg in st.session_state.messages[:-1]:
-            role = "user" if msg["role"] == "user" else "model"
-            history.append({"role": role, "parts": [msg["content"]]})
-
-        chat = model.start_chat(history=history)
-        formatted_prompt = format_response_with_mode(prompt)
-        response = chat.send_message(formatted_prompt)
-        return response.text
+        # History is every message except the latest user turn
+        history = build_history(st.session_state.messages[:-1])
+        formatted_prompt = format_response_with_mode(prompt, allow_edits)
+        attachments = st.session_state.messages[-1].attachments
+        model, route = resolve_model(prompt, history, attachments)
+        started = time.time()
+        response = request_completion(formatted_prompt, history, api_key, attachments=attachments, model=model)[0]
     except Exception as e:
+        if route:
+            get_model_router().record(route, time.time() - started, ok=False)
         st.error(f"Error generating response: {str(e)}")
         return None
+    if route:
+        get_model_router().record(route, time.time() - started, ok=True)
+    return response
+
+def regenerate_message(message: Message, api_key: str) -> bool:
+    """Fetch REGENERATE_CANDIDATES new answers in one round trip and cache them on the message.
+
+    Returns whether new alternatives were added.
+    """
+    messages = st.session_state.messages
+    user_message = messages[message.index - 1]
+    history = build_history(messages[:message.index - 1])
+    # A pending run error is kept for the next Debug Mode prompt
+    formatted_prompt = format_response_with_mode(user_message.content, include_run_error=False)
+    attachments = user_message.attachments
+    model = st.session_state.current_model
+    if model == AUTO_MODEL:
+        # A regenerated answer was not good enough, so Auto escalates to the strong model
+        route = st.session_state.routes.get(message.index)
+        if route:
+            get_model_router().retried(route)
+        st.session_state.routes[message.index] = "strong"
+        model = AUTO_ROUTES["strong"]
+    try:
+        try:
+            candidates = request_completion(
+                formatted_prompt, history, api_key, REGENERATE_CANDIDATES, attachments, model
+            )
+        except Exception as e:
+            # Models that reject candidate_count answer 400; ask several keys in parallel instead
+            if not is_rejected_request(e):
+                raise
+            candidates = []
+        if len(candidates) < 2:
+            candidates += request_concurrent_completions(
+                formatted_prompt, history, api_key, REGENERATE_CANDIDATES - len(candidates), attachments, model
+            )
+    except Exception as e:
+        st.error(f"Error regenerating response: {str(e)}")
+        return False
+    alternatives = message.alternatives or (message.content,)
+    # Identical candidates are common at low temperature and in replay; cache each text once
+    candidates = [c for c in dict.fromkeys(candidates) if c and c not in alternatives]
+    if not candidates:
+        st.toast("No new alternatives were generated")
+        return False
+    alternatives += tuple(candidates)
+    replace_message(dataclasses.replace(message, content=candidates[0], alternatives=alternatives))
+    return True
+
+def select_alternative(index: int, key: str):
+    """Radio callback: make the chosen cached alternative the message's content, and so the next turn's history"""
+    message = st.session_state.messages[index]
+    choice = st.session_state[key]
+    if message.alternatives[choice] != message.content:
+        replace_message(dataclasses.replace(message, content=message.alternatives[choice]))
+
+# Operations dashboard: a process-wide view of sessions and Gemini traffic,
+# shown instead of the chat when the URL carries ?admin=<FLUXCODE_ADMIN_TOKEN>
+ADMIN_TOKEN = os.getenv("FLUXCODE_ADMIN_TOKEN", "")
+ADMIN_PARAM = "admin"
+SESSION_IDLE_SECONDS = float(os.getenv("FLUXCODE_SESSION_IDLE_MINUTES", "30")) * 60
+OPS_WINDOW_SECONDS = 300  # rolling window for per-model request and error rates
+
+class SessionHandle:
+    """Kept in each session's state so the registry can release its transcripts from another thread"""
+
+    def __init__(self):
+        self.messages: list = []
+        self.saved: Dict = {}
+        self.run_results: Dict = {}
+        self.working_file_versions: Dict = {}
+        self.evicted = False
+
+    def release(self):
+        # Everything dropped is durable in the journals; the session reloads on its next run
+        self.evicted = True
+        self.messages.clear()
+        for conv in list(self.saved.values()):
+            conv["messages"] = None
+        self.run_results.clear()
+        self.working_file_versions.clear()
+
+class TrackedRequest:
+    """One Gemini call as seen by the operations registry"""
+
+    def __init__(self, registry: "OpsRegistry", ticket: int):
+        self.registry = registry
+        self.ticket = ticket
+
+    def first_chunk(self):
+        with self.registry.lock:
+            self.registry.requests[self.ticket]["streaming"] = True
+
+    def finish(self, status: Optional[int] = None):
+        """Record the outcome; status is the HTTP error status, None on success"""
+        self.registry.finish(self.ticket, status)
+
+class OpsRegistry:
+    """Live sessions, in-flight requests and per-model outcomes for the whole process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, Dict] = {}     # Streamlit session id -> stats and a weakref to its handle
+        self.requests: Dict[int, Dict] = {}     # ticket -> in-flight request
+        self.outcomes: Dict[str, deque] = {}    # model -> (time, ok, latency) within the window
+        self.totals: Dict[str, List[int]] = {}  # model -> [requests, errors]
+        self.next_ticket = 0
+
+    def report(self, session: str, handle: SessionHandle, stats: Dict):
+        with self.lock:
+            entry = self.sessions.setdefault(session, {})
+            entry.update(stats, handle=weakref.ref(handle), last_seen=time.time())
+
+    def track(self, session: Optional[str], model: str) -> TrackedRequest:
+        with self.lock:
+            self.next_ticket += 1
+            self.requests[self.next_ticket] = {
+                "session": session, "model": model, "started": time.time(), "streaming": False
+            }
+            return TrackedRequest(self, self.next_ticket)
+
+    def finish(self, ticket: int, status: Optional[int]):
+        with self.lock:
+            now = time.time()
+            request = self.requests.pop(ticket)
+            model = request["model"]
+            self.outcomes.setdefault(model, deque()).append((now, status is None, now - request["started"]))
+            totals = self.totals.setdefault(model, [0, 0])
+            totals[0] += 1
+            totals[1] += status is not None
+
+    def prune(self, now: float):
+        # Sessions whose state Streamlit has released are gone
+        for session in [s for s, entry in self.sessions.items() if entry["handle"]() is None]:
+            del self.sessions[session]
+        cutoff = now - OPS_WINDOW_SECONDS
+        for outcomes in self.outcomes.values():
+            while outcomes and outcomes[0][0] < cutoff:
+                outcomes.popleft()
+
+    def session_rows(self) -> List[Dict]:
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            rows = [
+                {
+                    "session": f"…{entry['sid'][-6:]}",
+                    "model": entry["model"],
+                    "messages": entry["messages"],
+                    "saved": entry["saved"],
+                    "memory_kb": round(entry["memory"] / 1024, 1),
+                    "idle_s": int(now - entry["last_seen"]),
+                    "in_flight": sum(1 for r in self.requests.values() if r["session"] == session)
+                }
+                for session, entry in self.sessions.items()
+            ]
+        return sorted(rows, key=lambda row: row["memory_kb"], reverse=True)
+
+    def request_rows(self) -> List[Dict]:
+        with self.lock:
+            now = time.time()
+            sids = {session: entry["sid"] for session, entry in self.sessions.items()}
+            rows = [
+                {
+                    "model": request["model"],
+                    "session": f"…{sids.get(request['session'], '?')[-6:]}",
+                    "state": "streaming" if request["streaming"] else "waiting",
+                    "age_s": round(now - request["started"], 1)
+                }
+                for request in self.requests.values()
+            ]
+        return sorted(rows, key=lambda row: row["age_s"], reverse=True)
+
+    def model_rows(self) -> List[Dict]:
+        with self.lock:
+            self.prune(time.time())
+            rows = []
+            for model, (requests, errors) in self.totals.items():
+                outcomes = self.outcomes.get(model, ())
+                latencies = sorted(latency for _, ok, latency in outcomes if ok)
+                rows.append({
+                    "model": model,
+                    "rpm": round(len(outcomes) * 60 / OPS_WINDOW_SECONDS, 1),
+                    "error_rate": round(sum(1 for _, ok, _ in outcomes if not ok) / len(outcomes), 2) if outcomes else 0.0,
+                    "p50_s": round(latencies[len(latencies) // 2], 2) if latencies else None,
+                    "in_flight": sum(1 for r in self.requests.values() if r["model"] == model),
+                    "requests": requests,
+                    "errors": errors
+                })
+            return rows
+
+    def evict_idle(self, idle_seconds: float) -> int:
+        """Release the transcripts of sessions idle for at least idle_seconds"""
+        with self.lock:
+            now = time.time()
+            self.prune(now)
+            busy = {r["session"] for r in self.requests.values()}
+            idle = [
+                (session, entry) for session, entry in self.sessions.items()
+                if now - entry["last_seen"] >= idle_seconds and session not in busy
+            ]
+        evicted = 0
+        for session, entry in idle:
+            handle = entry["handle"]()
+            if handle is None:
+                continue
+            handle.release()
+            with self.lock:
+                entry.update(messages=0, saved=0, memory=0)
+            evicted += 1
+        return evicted
+
+@st.cache_resource
+def get_ops_registry() -> OpsRegistry:
+    """Process-wide registry behind the operations dashboard"""
+    return OpsRegistry()
+
+def track_request(request: Dict) -> TrackedRequest:
+    """Register a Gemini call for the current session; call from the script thread"""
+    ctx = get_script_run_ctx()
+    return get_ops_registry().track(ctx.session_id if ctx else None, request["model"])
+
+def report_session():
+    """Publish this session's size to the operations registry"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    if "_ops_handle" not in st.session_state:
+        st.session_state._ops_handle = SessionHandle()
+    handle = st.session_state._ops_handle
+    handle.messages = st.session_state.messages
+    handle.saved = st.session_state.saved_conversations
+    handle.run_results = st.session_state.run_results
+    handle.working_file_versions = st.session_state.working_file_versions
+    get_ops_registry().report(ctx.session_id, handle, {
+        "sid": st.session_state.session_id,
+        "model": st.session_state.current_model,
+        "messages": len(st.session_state.messages),
+        "saved": len(st.session_state.saved_conversations),
+        "memory": estimate_session_memory()
+    })
+
+def process_memory_mb() -> Optional[float]:
+    """Resident memory of this process, where /proc is available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def render_ops_dashboard():
+    """Process-wide operations page: sessions, memory, in-flight requests and per-model rates"""
+    registry = get_ops_registry()
+    st.markdown("## 🛠️ Operations")
+    if st.button("🔄 Refresh"):
+        st.rerun()
+
+    sessions = registry.session_rows()
+    requests = registry.request_rows()
+    rss = process_memory_mb()
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        st.metric("Active Sessions", len(sessions))
+    with col2:
+        st.metric("Session Memory", f"{sum(s['memory_kb'] for s in sessions) / 1024:.1f} MB")
+    with col3:
+        st.metric("Process RSS", f"{rss:.0f} MB" if rss is not None else "n/a")
+    with col4:
+        st.metric("In Flight", len(requests))
+    with col5:
+        st.metric("Awaiting First Chunk", sum(1 for r in requests if r["state"] == "waiting"))
+
+    st.markdown("### Sessions")
+    idle_minutes = SESSION_IDLE_SECONDS / 60
+    if st.button(f"🧹 Evict sessions idle for {idle_minutes:g}+ min"):
+        evicted = registry.evict_idle(SESSION_IDLE_SECONDS)
+        st.toast(f"Evicted {evicted} idle session(s)")
+        sessions = registry.session_rows()
+    st.dataframe(sessions, hide_index=True, use_container_width=True)
+
+    st.markdown("### Gemini Requests")
+    st.caption(f"Rates over the last {OPS_WINDOW_SECONDS // 60} minutes · journal backlog: {get_journal().backlog()} entries")
+    st.dataframe(registry.model_rows(), hide_index=True, use_container_width=True)
+    if requests:
+        st.dataframe(requests, hide_index=True, use_container_width=True)
+
+    router = get_model_router()
+    st.markdown("### Model Routing")
+    st.caption(f"Auto threshold {router.threshold:.2f} · target fast retry rate {router.target_retry_rate():.0%}")
+    st.dataframe(router.metrics(), hide_index=True, use_container_width=True)
+
+    pool = get_key_pool()
+    if len(pool) > 1:
+        st.markdown("### Key Pool")
+        st.dataframe(pool.metrics(), hide_index=True, use_container_width=True)
 
 def main():
     """Main application function"""
+    # The operations page is process-wide and never creates a chat session
+    admin_token = st.query_params.get(ADMIN_PARAM)
+    if admin_token is not None:
+        inject_modern_css()
+        if ADMIN_TOKEN and hmac.compare_digest(admin_token.encode(), ADMIN_TOKEN.encode()):
+            render_ops_dashboard()
+        else:
+            st.error("Invalid admin token")
+        return
+
     # Initialize session state first so all downstream functions see correct defaults
     initialize_session_state()
     inject_modern_css()
@@ -889,36 +3016,51 @@ def main():
     for message in st.session_state.messages:
         display_message(message)
     
+    if st.session_state.patch_mode:
+        display_working_file()
+    
+    uploaded_files = st.file_uploader(
+        "📎 Attach files",
+        type=ATTACHMENT_TYPES,
+        accept_multiple_files=True,
+        key=f"attachments_{st.session_state.uploader_key}",
+        help="Screenshots are downscaled and logs trimmed before upload"
+    )
+    
     # Chat input
     if prompt := st.chat_input("Ask me anything about coding..."):
-        if not api_key:
+        if not api_key and not len(get_key_pool()) and get_generation_backend().requires_key:
             st.error("Please enter your Gemini API key in the sidebar")
             return
         
-        # Add user message to chat history
-        user_message = {
-            "role": "user",
-            "content": prompt,
-            "id": f"user_{len(st.session_state.messages)}",
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        st.session_state.messages.append(user_message)
+        # Prepare attachments and add user message to chat history
+        store = get_attachment_store()
+        attachments = []
+        for uploaded in uploaded_files or []:
+            try:
+                attachments.append(store.add(uploaded.name, uploaded.getvalue()))
+            except (OSError, Image.DecompressionBombError):
+                # Corrupt or mislabeled images fail in PIL (UnidentifiedImageError is an OSError)
+                st.error(f"Could not read attachment {uploaded.name}; remove it and try again")
+                return
+        attachments = tuple(attachments)
+        user_message = append_message("user", prompt, attachments)
+        if attachments:
+            # A fresh uploader key clears the files that were just sent
+            st.session_state.uploader_key += 1
         
         # Display user message
-        with st.chat_message("user"):
-            st.markdown(prompt)
+        display_message(user_message)
         
         # Generate and display assistant response
         with st.spinner("Generating response..."):
             response = generate_response(prompt, api_key)
+            if response and st.session_state.patch_mode:
+                response = update_working_file(prompt, response, api_key)
             if response:
-                assistant_message = {
-                    "role": "assistant",
-                    "content": response,
-                    "id": f"assistant_{len(st.session_state.messages)}",
-                    "timestamp": datetime.datetime.now().isoformat()
-                }
-                st.session_state.messages.append(assistant_message)
+                assistant_message = append_message("assistant", response)
+                if st.session_state.last_route:
+                    st.session_state.routes[assistant_message.index] = st.session_state.last_route
                 
                 # Display assistant message
                 display_message(assistant_message)
@@ -926,5 +3068,8 @@ def main():
                 # Update stats
                 st.session_state.message_count += 1
 
+    persist_session_state()
+    report_session()
+
 if __name__ == "__main__":
     main()
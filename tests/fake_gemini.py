@@ -0,0 +1,91 @@
+"""Local stand-in for the Gemini REST API with per-key quotas.
+
+Point GEMINI_API_ENDPOINT (or app.GEMINI_API_ENDPOINT) at ``server.endpoint``.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROUTE = re.compile(r"^/v1beta/models/(?P<model>[^:]+):(?P<method>generateContent|streamGenerateContent)$")
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """Answers generateContent calls; each key may make quotas[key] calls before it gets 429.
+
+    Requests for more than max_candidates candidates get 400, as from models
+    without candidate_count support.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, quotas=None, forbidden=(), max_candidates=8):
+        super().__init__(("127.0.0.1", 0), FakeGeminiHandler)
+        self.lock = threading.Lock()
+        self.quotas = dict(quotas or {})
+        self.forbidden = set(forbidden)
+        self.max_candidates = max_candidates
+        self.calls = []  # (key, model) per request, including rejected ones
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def admit(self, key: str, model: str) -> int:
+        """HTTP status for a call with this key, consuming quota"""
+        with self.lock:
+            self.calls.append((key, model))
+            if key in self.forbidden:
+                return 403
+            remaining = self.quotas.get(key)
+            if remaining is not None:
+                if remaining <= 0:
+                    return 429
+                self.quotas[key] = remaining - 1
+            return 200
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        match = ROUTE.match(url.path)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or "{}")
+        if not match:
+            return self._send(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+        key = self.headers.get("x-goog-api-key") or parse_qs(url.query).get("key", [""])[0]
+        status = self.server.admit(key, match.group("model"))
+        if status == 429:
+            return self._send(429, {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}})
+        if status == 403:
+            return self._send(403, {"error": {"code": 403, "message": "API key not valid", "status": "PERMISSION_DENIED"}})
+        count = body.get("generationConfig", {}).get("candidateCount", 1)
+        if count > self.server.max_candidates:
+            return self._send(400, {"error": {"code": 400, "message": "Multiple candidates is not enabled for this model", "status": "INVALID_ARGUMENT"}})
+        response = {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": f"answer {i} from {key}" if i else f"answer from {key}"}]},
+                "finishReason": "STOP",
+                "index": i
+            } for i in range(count)]
+        }
+        streaming = match.group("method") == "streamGenerateContent"
+        self._send(200, [response] if streaming else response)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
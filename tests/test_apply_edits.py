@@ -0,0 +1,61 @@
+import pytest
+
+SOURCE = "def count(items):\n    n = 0\n    for item in items:\n        n += 1\n    return n\n"
+
+def edit(search, replace):
+    return f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE"
+
+def diff_block(*lines):
+    return "```diff\n" + "\n".join(lines) + "\n```"
+
+def test_search_replace_edits_apply_in_order(app):
+    response = "Two fixes:\n" + edit("    n = 0", "    n = 0  # total") + "\n\n" + edit("    return n", "    return int(n)")
+    assert app.apply_edits(SOURCE, response) == SOURCE.replace("n = 0", "n = 0  # total").replace("return n", "return int(n)")
+
+def test_search_replace_matches_at_end_of_file(app):
+    assert app.apply_edits("a\nb", edit("b", "c")) == "a\nc"
+
+@pytest.mark.parametrize("search, reason", [("    x = 1", "not found"), ("n", "is ambiguous")])
+def test_search_must_occur_exactly_once(app, search, reason):
+    with pytest.raises(ValueError, match=reason):
+        app.apply_edits(SOURCE, edit(search, "y"))
+
+def test_response_without_edits_returns_none(app):
+    assert app.apply_edits(SOURCE, "```python\nprint('whole file')\n```") is None
+
+def test_unified_diff_skips_file_headers(app):
+    response = diff_block(
+        "--- a/count.py",
+        "+++ b/count.py",
+        "@@ -4,2 +4,2 @@",
+        "         n += 1",
+        "-    return n",
+        "+    return int(n)"
+    )
+    assert app.apply_edits(SOURCE, response) == SOURCE.replace("return n", "return int(n)")
+
+def test_unified_diff_keeps_marker_like_lines_inside_hunks(app):
+    source = "int i = 0;\n-- old comment\nreturn i;"
+    response = diff_block(
+        "--- a/main.c",
+        "+++ b/main.c",
+        "@@ -1,3 +1,3 @@",
+        " int i = 0;",
+        "--- old comment",
+        "+++i;",
+        " return i;"
+    )
+    assert app.apply_edits(source, response) == "int i = 0;\n++i;\nreturn i;"
+
+def test_unified_diff_uses_context_nearest_the_stated_line(app):
+    source = "x\ny\nx\ny"
+    response = diff_block("@@ -3,2 +3,2 @@", " x", "-y", "+z")
+    assert app.apply_edits(source, response) == "x\ny\nx\nz"
+
+def test_unified_diff_inserts_pure_additions(app):
+    response = diff_block("@@ -1,0 +2 @@", "+b")
+    assert app.apply_edits("a\nc", response) == "a\nb\nc"
+
+def test_unified_diff_rejects_mismatched_context(app):
+    with pytest.raises(ValueError, match="does not match"):
+        app.apply_edits(SOURCE, diff_block("@@ -1 +1 @@", "-missing", "+found"))
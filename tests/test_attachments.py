@@ -0,0 +1,43 @@
+import os
+import time
+
+def age(store, attachment, seconds):
+    path = store.path(attachment[0])
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+def test_same_upload_is_prepared_once(app, tmp_path):
+    store = app.AttachmentStore(str(tmp_path))
+    first = store.add("a.log", b"x\nx\nx\n")
+    second = store.add("b.log", b"x\nx\nx\n")
+    assert first[0] == second[0] and second[1] == "b.log"
+    assert os.listdir(tmp_path) == [first[0]]
+
+def test_prune_deletes_unused_files_and_forgets_them(app, tmp_path):
+    store = app.AttachmentStore(str(tmp_path), max_age=60)
+    old = store.add("old.txt", b"old")
+    fresh = store.add("fresh.txt", b"fresh")
+    store.uploads[("key", old[0])] = ({"file_data": {}}, time.time() + 3600)
+    store.uploads[("key", "expired")] = ({"file_data": {}}, time.time() - 1)
+    age(store, old, 120)
+    store.prune()
+    assert os.listdir(tmp_path) == [fresh[0]]
+    assert [a[0] for a in store.prepared.values()] == [fresh[0]]
+    assert store.uploads == {}
+    # A pruned attachment is prepared again on its next upload
+    assert store.add("old.txt", b"old") == old
+    assert os.path.exists(store.path(old[0]))
+
+def test_prune_keeps_the_directory_under_its_size_cap(app, tmp_path):
+    store = app.AttachmentStore(str(tmp_path), max_bytes=25)
+    attachments = [store.add(f"{n}.txt", str(n).encode() * 10) for n in range(3)]
+    for seconds, attachment in zip((30, 20, 10), attachments):
+        age(store, attachment, seconds)
+    store.prune()
+    assert sorted(os.listdir(tmp_path)) == sorted(a[0] for a in attachments[1:])
+
+def test_pruned_attachment_without_upload_resolves_to_nothing(app, tmp_path):
+    store = app.AttachmentStore(str(tmp_path))
+    attachment = store.add("gone.txt", b"gone")
+    os.remove(store.path(attachment[0]))
+    assert store.file_part("key", attachment) is None
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+@pytest.fixture
+def backend(app, tmp_path):
+    return app.SQLiteStateBackend(str(tmp_path / "state.db"))
+
+@pytest.fixture
+def journal(app, backend):
+    # A long flush interval leaves flushing to the test
+    return app.Journal(backend, flush_interval=60, compact_every=4)
+
+def record(app, index, content):
+    return app.Message("user", content, index, 0, (), ()).to_record()
+
+def test_replay_applies_append_truncate_and_replace(app):
+    entries = [
+        ["m", ["user", "a", 0, 0]],
+        ["m", ["assistant", "b", 1, 0]],
+        ["m", ["user", "c", 2, 0]],
+        ["t", 2],
+        ["r", 1, ["assistant", "b2", 1, 0, ["b", "b2"]]],
+        ["m", ["user", "d", 2, 0]]
+    ]
+    records = app.replay_journal(entries)
+    assert [r[1] for r in records] == ["a", "b2", "d"]
+    message = app.Message.from_record(records[1])
+    assert message.alternatives == ("b", "b2")
+
+def test_tabs_appending_to_one_log_keep_indexes_unique(app, journal):
+    # Two tabs on the same session both continue from a two-message transcript
+    journal.append("c", ["m", record(app, 0, "q1")])
+    journal.append("c", ["m", record(app, 1, "a1")])
+    journal.flush()
+    for tab in ("A", "B"):
+        journal.append("c", ["m", record(app, 2, f"q2 {tab}")])
+        journal.append("c", ["m", record(app, 3, f"a2 {tab}")])
+        journal.flush()
+    records = journal.read("c")
+    assert [r[2] for r in records] == [0, 1, 2, 3]
+    assert [r[1] for r in records] == ["q1", "a1", "q2 B", "a2 B"]
+
+def test_entries_past_a_truncated_transcript_are_skipped(app):
+    entries = [
+        ["m", ["user", "a", 0, 0]],
+        ["m", ["assistant", "b", 1, 0]],
+        ["t", 0],
+        # Another tab had not seen the truncation yet
+        ["m", ["user", "c", 2, 0]],
+        ["r", 1, ["assistant", "b2", 1, 0]],
+        ["m", ["user", "d", 0, 0]]
+    ]
+    assert app.replay_journal(entries) == [["user", "d", 0, 0]]
+
+def test_read_includes_queued_entries(app, journal, backend):
+    journal.append("c", ["m", record(app, 0, "hello")])
+    assert backend.read_log("c") == []
+    assert [r[1] for r in journal.read("c")] == ["hello"]
+    assert len(backend.read_log("c")) == 1
+
+def test_truncate_to_empty_rewrites_the_log(app, journal, backend):
+    journal.append("c", ["m", record(app, 0, "old")])
+    journal.flush()
+    journal.append("c", ["m", record(app, 1, "dropped")])
+    journal.append("c", ["t", 0])
+    journal.append("c", ["m", record(app, 0, "new")])
+    journal.flush()
+    assert [json.loads(e)[0] for e in backend.read_log("c")] == ["m"]
+    assert [r[1] for r in journal.read("c")] == ["new"]
+
+def test_compaction_folds_replacements(app, journal, backend):
+    journal.append("c", ["m", record(app, 0, "v0")])
+    for n in range(1, 6):
+        journal.append("c", ["r", 0, record(app, 0, f"v{n}")])
+    journal.flush()
+    # Six entries crossed compact_every, so the log holds one record per message
+    assert len(backend.read_log("c")) == 1
+    assert [r[1] for r in journal.read("c")] == ["v5"]
+
+def test_failed_flush_is_retried_in_order(app, journal, backend, monkeypatch):
+    journal.append("c", ["m", record(app, 0, "first")])
+    original = backend.append_log
+
+    def failing(key, entries):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(backend, "append_log", failing)
+    journal.flush()
+    journal.append("c", ["m", record(app, 1, "second")])
+    monkeypatch.setattr(backend, "append_log", original)
+    journal.flush()
+    assert [r[1] for r in journal.read("c")] == ["first", "second"]
+
+def test_drop_discards_queued_and_stored_entries(app, journal, backend):
+    journal.append("c", ["m", record(app, 0, "stored")])
+    journal.flush()
+    journal.append("c", ["m", record(app, 1, "queued")])
+    journal.drop("c")
+    assert journal.read("c") == []
+    assert journal.backlog() == 0
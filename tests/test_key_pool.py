@@ -0,0 +1,93 @@
+from collections import Counter
+
+import pytest
+
+from fake_gemini import FakeGeminiServer
+
+MODEL = "gemini-2.0-flash"
+
+@pytest.fixture
+def gemini(app, monkeypatch):
+    """Route live requests to a local fake server; tests set quotas on it"""
+    with FakeGeminiServer() as server:
+        monkeypatch.setattr(app, "GEMINI_API_ENDPOINT", server.endpoint)
+        monkeypatch.setattr(app, "get_generation_backend", lambda: app.LiveBackend())
+        # Clients are cached per key and bound to an endpoint
+        app.get_generative_client.clear()
+        yield server
+        app.get_generative_client.clear()
+
+def use_pool(app, monkeypatch, spec):
+    pool = app.ApiKeyPool(spec)
+    monkeypatch.setattr(app, "get_key_pool", lambda: pool)
+    return pool
+
+def complete(app):
+    return app.request_completion("hi", [], "", model=MODEL)[0]
+
+def by_key(pool):
+    return {row["key"][-2:]: row for row in pool.metrics()}
+
+def test_spec_parses_weights_and_skips_duplicates(app):
+    pool = app.ApiKeyPool("k1, k2:3,k1:5,")
+    assert [(k.key, k.weight) for k in pool.keys] == [("k1", 1.0), ("k2", 3.0)]
+
+def test_equal_keys_rotate(app):
+    pool = app.ApiKeyPool("k1,k2,k3")
+    picks = []
+    for _ in range(6):
+        pooled = pool.acquire()
+        picks.append(pooled.key)
+        pool.release(pooled)
+    assert Counter(picks) == {"k1": 2, "k2": 2, "k3": 2}
+
+def test_weights_scale_the_share_of_requests(app):
+    pool = app.ApiKeyPool("k1,k2:3")
+    picks = []
+    for _ in range(8):
+        pooled = pool.acquire()
+        picks.append(pooled.key)
+        pool.release(pooled)
+    assert Counter(picks) == {"k1": 2, "k2": 6}
+
+def test_keys_over_their_rpm_are_avoided(app, monkeypatch):
+    monkeypatch.setattr(app, "KEY_RPM_LIMIT", 2)
+    pool = app.ApiKeyPool("k1:10,k2")
+    picks = [pool.acquire().key for _ in range(4)]
+    assert picks == ["k1", "k1", "k2", "k2"]
+
+def test_rate_limited_key_is_quarantined_and_request_retried(app, monkeypatch, gemini):
+    pool = use_pool(app, monkeypatch, "k1,k2")
+    gemini.quotas = {"k1": 1}
+    assert complete(app) == "answer from k1"
+    assert complete(app) == "answer from k2"
+    # k1 is out of quota: the request fails over to k2, and k1 sits out
+    assert complete(app) == "answer from k2"
+    metrics = by_key(pool)
+    assert 0 < metrics["k1"]["quarantined_s"] <= app.QUARANTINE_SECONDS[429]
+    assert metrics["k1"]["errors"] == 1
+    assert [key for key, _ in gemini.calls] == ["k1", "k2", "k1", "k2"]
+    # Quarantined keys are skipped while healthy ones remain
+    for _ in range(3):
+        assert complete(app) == "answer from k2"
+    assert all(row["in_flight"] == 0 for row in pool.metrics())
+
+def test_forbidden_key_gets_the_long_quarantine(app, monkeypatch, gemini):
+    pool = use_pool(app, monkeypatch, "bad,k2")
+    gemini.forbidden = {"bad"}
+    assert complete(app) == "answer from k2"
+    assert by_key(pool)["ad"]["quarantined_s"] > app.QUARANTINE_SECONDS[429]
+
+def test_error_is_raised_when_every_key_is_exhausted(app, monkeypatch, gemini):
+    pool = use_pool(app, monkeypatch, "k1,k2")
+    gemini.quotas = {"k1": 0, "k2": 0}
+    with pytest.raises(Exception) as error:
+        complete(app)
+    assert app.get_error_status(error.value) == 429
+    assert len(gemini.calls) == 2
+    assert all(row["quarantined_s"] > 0 and row["in_flight"] == 0 for row in pool.metrics())
+
+def test_sidebar_key_bypasses_the_pool(app, monkeypatch, gemini):
+    pool = use_pool(app, monkeypatch, "k1,k2")
+    assert app.request_completion("hi", [], "mine", model=MODEL) == ["answer from mine"]
+    assert all(row["requests"] == 0 for row in pool.metrics())
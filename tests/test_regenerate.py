@@ -0,0 +1,60 @@
+import os
+
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+from fake_gemini import FakeGeminiServer
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+@pytest.fixture
+def gemini(monkeypatch, tmp_path):
+    """A fake server behind a two-key pool, with the app's state in a fresh database"""
+    with FakeGeminiServer() as server:
+        monkeypatch.setenv("GEMINI_API_ENDPOINT", server.endpoint)
+        monkeypatch.setenv("GOOGLE_API_KEYS", "k1,k2")
+        monkeypatch.setenv("FLUXCODE_STATE_DB", str(tmp_path / "state.db"))
+        # The key pool, clients and state backend are process-wide resources
+        st.cache_resource.clear()
+        yield server
+        st.cache_resource.clear()
+
+def answered(question="Write hello world"):
+    at = AppTest.from_file(APP_PATH, default_timeout=30)
+    at.run()
+    at.chat_input[0].set_value(question).run()
+    return at
+
+def regenerate(at):
+    next(b for b in at.button if b.key == "regenerate_assistant_1").click().run()
+
+def test_regenerate_asks_for_several_candidates_in_one_call(gemini):
+    at = answered()
+    assert at.session_state.messages[1].content == "answer from k1"
+    regenerate(at)
+    message = at.session_state.messages[1]
+    assert message.alternatives == ("answer from k1", "answer from k2", "answer 1 from k2", "answer 2 from k2")
+    assert message.content == "answer from k2"
+    assert len(gemini.calls) == 2
+    assert not at.exception
+
+def test_regenerate_falls_back_to_concurrent_requests(gemini):
+    gemini.max_candidates = 1
+    at = answered()
+    regenerate(at)
+    # One rejected multi-candidate call, then one single-candidate call per alternative
+    assert len(gemini.calls) == 1 + 1 + 3
+    message = at.session_state.messages[1]
+    assert message.alternatives == ("answer from k1", "answer from k2")
+    assert not at.exception
+
+def test_regenerate_failure_is_shown_and_keeps_the_pending_run_error(gemini):
+    at = answered()
+    gemini.quotas = {"k1": 0, "k2": 0}
+    at.session_state.debug_mode = True
+    at.session_state.pending_run_error = "ZeroDivisionError: division by zero"
+    regenerate(at)
+    assert any("Error regenerating response" in e.value for e in at.error)
+    assert at.session_state.messages[1].alternatives == ()
+    assert at.session_state.pending_run_error == "ZeroDivisionError: division by zero"
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(request, app, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        return app.SQLiteStateBackend(str(tmp_path / "state.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    # Any Redis-protocol server will do; fakeredis keeps it in-process
+    monkeypatch.setattr(app.redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(**kwargs))
+    return app.RedisStateBackend("redis://unused")
+
+def test_missing_key_has_version_zero(backend):
+    assert backend.get("nope") == (0, None)
+
+def test_put_creates_then_requires_current_version(backend):
+    assert backend.put("s", "a", 0)
+    assert backend.get("s") == (1, "a")
+    # A second creator loses
+    assert not backend.put("s", "b", 0)
+    assert backend.put("s", "b", 1)
+    assert backend.get("s") == (2, "b")
+
+def test_stale_version_is_rejected(backend):
+    backend.put("s", "a", 0)
+    backend.put("s", "b", 1)
+    assert not backend.put("s", "stale", 1)
+    assert backend.get("s") == (2, "b")
+
+def test_concurrent_writers_of_one_version_have_one_winner(backend):
+    backend.put("s", "start", 0)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def write(n):
+        barrier.wait()
+        results.append(backend.put("s", f"writer {n}", 1))
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    version, payload = backend.get("s")
+    assert version == 2 and payload.startswith("writer ")
+
+def test_logs_append_replace_and_delete(backend):
+    backend.append_log("c", ["1", "2"])
+    backend.append_log("c", ["3"])
+    backend.append_log("other", ["x"])
+    assert backend.read_log("c") == ["1", "2", "3"]
+    backend.replace_log("c", ["compact"])
+    assert backend.read_log("c") == ["compact"]
+    backend.replace_log("c", [])
+    assert backend.read_log("c") == []
+    backend.delete_log("other")
+    assert backend.read_log("other") == []
+
+def test_incomplete_backend_fails_when_created(app):
+    class NoLogs(app.StateBackend):
+        def get(self, key):
+            return 0, None
+
+        def put(self, key, payload, expected_version):
+            return True
+
+    with pytest.raises(TypeError, match="append_log"):
+        NoLogs()